@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+run_benchmarks.py
+
+Times each stage of SNAPPY on synthetic cohorts of increasing size. Each cohort is run through the same code as the
+snappy command, and the time of each stage (reference load, allele orientation, decode, tally, scoring, leaf picking,
+formatting and output) is read from the run's metrics. Each run is saved as a json file in the results directory and
+compared with the previous run on the same machine, so slowdowns show up as regressions.
+
+    python benchmarks/run_benchmarks.py --sizes 1000,10000,100000,1000000
+"""
+
+import argparse
+import contextlib
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snappy.main import get_snappy_parser
+from snappy.bin.compile_refs import get_ref_files, get_compiled_refs, DEFAULT_REF_FILE_NAMES
+from snappy.bin.run_metrics import RunMetrics
+from snappy.bin.SNAPPY import run_snappy_stages
+from synthetic_cohort import write_cohort
+
+# stages recorded by RunMetrics; with more than one process, tally, scoring and leaf picking are timed together as parallel_scoring
+STAGES = ['reference_load', 'allele_orientation', 'decode', 'tally', 'scoring', 'leaf_picking', 'parallel_scoring', 'formatting', 'output']
+
+# a stage is reported as a regression when it is this much slower than in the previous run
+REGRESSION_RATIO = 1.25
+
+
+def time_cohort(ref_files_dir, prefix, chunk_size, processes=1):
+    """
+    runs SNAPPY on a plink library as the snappy command does, returning the wall seconds of each stage recorded in the
+    run's metrics, the seconds taken to compile the reference and the assignments
+    """
+    work_dir, name = os.path.split(os.path.abspath(prefix))
+    ref_files = get_ref_files(ref_files_dir, *DEFAULT_REF_FILE_NAMES)
+    cache_dir = tempfile.mkdtemp(prefix='snappy_bench_refs_')
+    cwd = os.getcwd()
+    try:
+        # compile into an empty cache, so the run times loading the compiled bundle as a normal run would
+        start = time.time()
+        get_compiled_refs(ref_files, cache_dir)
+        compile_seconds = time.time() - start
+
+        # snappy reads its input and reference files and writes its output relative to the working directory
+        args = get_snappy_parser().parse_args(['--infile', name, '--out', name, '--ref_files_dir', os.path.relpath(os.path.abspath(ref_files_dir), work_dir),
+                                               '--ref_cache_dir', cache_dir, '--chunk_size', str(chunk_size), '--processes', str(processes)])
+        metrics = RunMetrics()
+        os.chdir(work_dir)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run_snappy_stages(args, metrics)
+        summary = metrics.get_summary()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    timings = dict((stage, summary['stages'][stage]['wall_seconds']) for stage in STAGES if stage in summary['stages'])
+    timings['total'] = summary['wall_seconds']
+    assigned = dict()
+    with open(prefix + '.out', 'r') as infp:
+        for line in infp:
+            fields = line.split('\t')
+            assigned[fields[0]] = fields[1]
+    for extension in ('.out', '.all'):
+        os.remove(prefix + extension)
+    return timings, compile_seconds, assigned
+
+
+def get_accuracy(refs_tree, truth_file, assigned):
+    """returns the fraction of individuals assigned their true haplogroup, or one of its ancestors or descendants"""
+    exact = 0
+    lineage = 0
+    with open(truth_file, 'r') as infp:
+        for line in infp:
+            sample_id, true_hg = line.rstrip('\n').split('\t')
+            hg = assigned.get(sample_id)
+            if hg == true_hg:
+                exact += 1
+                lineage += 1
+            elif hg in refs_tree and (true_hg in refs_tree.get_ancestry(hg) or hg in refs_tree.get_ancestry(true_hg)):
+                lineage += 1
+    return exact / float(max(len(assigned), 1)), lineage / float(max(len(assigned), 1))
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def find_previous(results_dir, machine):
+    """returns the most recent saved run from the same machine, or None"""
+    for filename in sorted(glob.glob(os.path.join(results_dir, '*.json')), reverse=True):
+        with open(filename, 'r') as infp:
+            result = json.load(infp)
+        if result.get('machine') == machine:
+            return result
+    return None
+
+
+def report(result, previous):
+    """prints per-stage timings, with the ratio to the previous run where there is one"""
+    previous_sizes = dict((run['n_samples'], run) for run in previous['runs']) if previous else dict()
+    regressions = []
+    for run in result['runs']:
+        print('\n%s samples: %.1f samples/s, %.4f exact, %.4f same lineage' % (run['n_samples'], run['samples_per_second'], run['exact'], run['same_lineage']))
+        before = previous_sizes.get(run['n_samples'])
+        for stage in [stage for stage in STAGES + ['total'] if stage in run['seconds']]:
+            line = '  %-18s %9.3fs' % (stage, run['seconds'][stage])
+            if before and before['seconds'].get(stage):
+                ratio = run['seconds'][stage] / before['seconds'][stage]
+                line += '  %5.2fx previous (%s)' % (ratio, previous['commit'])
+                if ratio > REGRESSION_RATIO and run['seconds'][stage] > 0.05:
+                    line += '  REGRESSION'
+                    regressions.append('%s samples, %s' % (run['n_samples'], stage))
+            print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='run_benchmarks', description='Time the stages of SNAPPY on synthetic cohorts')
+    parser.add_argument('--sizes', help='comma-separated cohort sizes', type=str, default='1000,10000,100000,1000000', required=False)
+    parser.add_argument('--missing_rate', help='fraction of genotype calls set to missing', type=float, default=0.02, required=False)
+    parser.add_argument('--error_rate', help='fraction of genotype calls switched between derived and ancestral', type=float, default=0.001, required=False)
+    parser.add_argument('--chunk_size', help='number of samples read and scored at a time', type=int, default=10000, required=False)
+    parser.add_argument('--processes', help='number of processes used to score samples', type=int, default=1, required=False)
+    parser.add_argument('--ref_files_dir', help='directory where reference file are stored', type=str, default='ref_files', required=False)
+    parser.add_argument('--results_dir', help='directory where benchmark results are saved', type=str, default='benchmarks/results', required=False)
+    parser.add_argument('--work_dir', help='directory for the synthetic cohorts, a temporary directory by default', type=str, required=False)
+    parser.add_argument('--no_save', help='do not save the results of this run', action='store_true', required=False)
+    args = parser.parse_args()
+
+    ref_files = get_ref_files(args.ref_files_dir, *DEFAULT_REF_FILE_NAMES)
+    refs = get_compiled_refs(ref_files, '')
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='snappy_bench_')
+    machine = '%s-%s-%s' % (platform.node(), platform.machine(), platform.python_version())
+    result = {'commit': get_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'), 'machine': machine,
+              'missing_rate': args.missing_rate, 'error_rate': args.error_rate, 'chunk_size': args.chunk_size, 'processes': args.processes, 'runs': []}
+    try:
+        for n_samples in [int(size) for size in args.sizes.split(',')]:
+            prefix = os.path.join(work_dir, 'synthetic_%s' % (n_samples))
+            start = time.time()
+            write_cohort(refs, prefix, n_samples, args.missing_rate, args.error_rate)
+            print('Generated %s samples in %.1fs' % (n_samples, time.time() - start))
+            timings, compile_seconds, assigned = time_cohort(args.ref_files_dir, prefix, args.chunk_size, args.processes)
+            exact, lineage = get_accuracy(refs.tree, prefix + '.truth', assigned)
+            result['runs'].append({'n_samples': n_samples, 'seconds': timings, 'samples_per_second': n_samples / timings['total'],
+                                   'reference_compile_seconds': compile_seconds,
+                                   'exact': exact, 'same_lineage': lineage})
+            for extension in ('.bed', '.bim', '.fam', '.truth'):
+                os.remove(prefix + extension)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    previous = find_previous(args.results_dir, machine) if os.path.isdir(args.results_dir) else None
+    regressions = report(result, previous)
+    if not args.no_save:
+        if not os.path.isdir(args.results_dir):
+            os.makedirs(args.results_dir)
+        result_file = os.path.join(args.results_dir, '%s_%s.json' % (result['date'].replace(':', ''), result['commit']))
+        with open(result_file, 'w') as outfp:
+            json.dump(result, outfp, indent=1)
+        print('\nSaved results to %s' % (result_file))
+    if regressions:
+        print('\nRegressions: %s' % ('; '.join(regressions)))
+        sys.exit(1)
+    sys.exit()
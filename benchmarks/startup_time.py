@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+startup_time.py
+
+Measures how long SNAPPY takes from the command line for runs dominated by startup: the no-op path (snappy --help)
+and a single-sample run against the packaged default references, started in a directory without ref_files. Each
+path is run several times and the median wall time is compared with its budget; the script exits with an error when
+a budget is exceeded.
+
+    python benchmarks/startup_time.py --repeats 5
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+from snappy.bin.compile_refs import load_compiled_refs, PACKAGED_REF_BUNDLE
+from synthetic_cohort import write_cohort
+
+# median wall time allowed for each path, in seconds
+NOOP_BUDGET = 0.15
+SINGLE_SAMPLE_BUDGET = 1.0
+
+
+def time_command(command, cwd, repeats):
+    """runs a command repeats times, returning the median wall time in seconds"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    seconds = []
+    for n in range(repeats):
+        start = time.time()
+        subprocess.check_call(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL)
+        seconds.append(time.time() - start)
+    return sorted(seconds)[len(seconds) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='startup_time', description='Check SNAPPY startup time against its budgets')
+    parser.add_argument('--repeats', help='number of times each path is run', type=int, default=5, required=False)
+    parser.add_argument('--noop_budget', help='budget for snappy --help, in seconds', type=float, default=NOOP_BUDGET, required=False)
+    parser.add_argument('--single_sample_budget', help='budget for assigning one sample, in seconds', type=float, default=SINGLE_SAMPLE_BUDGET, required=False)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='snappy_startup_')
+    try:
+        write_cohort(load_compiled_refs(PACKAGED_REF_BUNDLE), os.path.join(work_dir, 'one_sample'), 1, 0.02, 0.001)
+        snappy = [sys.executable, '-m', 'snappy.main']
+        timings = [('no-op (--help)', time_command(snappy + ['--help'], work_dir, args.repeats), args.noop_budget),
+                   ('single sample', time_command(snappy + ['--infile', 'one_sample', '--out', 'one_sample'], work_dir, args.repeats), args.single_sample_budget)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    over_budget = []
+    for name, seconds, budget in timings:
+        status = 'ok' if seconds <= budget else 'OVER BUDGET'
+        print('%-16s %7.3fs  (budget %.3fs)  %s' % (name, seconds, budget, status))
+        if seconds > budget:
+            over_budget.append(name)
+    if over_budget:
+        sys.exit(1)
+    sys.exit()
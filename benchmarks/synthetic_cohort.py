@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+synthetic_cohort.py
+
+Writes a synthetic plink library (.bed, .bim, .fam) for benchmarking SNAPPY. Each individual is given a haplogroup
+drawn from the reference tree and is derived at the defining snps of that haplogroup and all of its ancestors, and
+ancestral everywhere else. Missing calls and genotyping errors are then added at the requested rates. The assigned
+haplogroups are written to a .truth file that can be given to SNAPPY's --sweep_truth.
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snappy.bin.parse_plink_files import BED_MAGIC, BED_HOM_A1, BED_MISSING, BED_HOM_A2
+from snappy.bin.compile_refs import get_ref_files, get_compiled_refs
+
+# snps are generated and written this many at a time, so memory does not grow with the number of snps
+SNP_BLOCK = 64
+
+
+def get_path_incidence(refs):
+    """returns a haplogroups x snps bool array marking the defining snps of each haplogroup and its ancestors"""
+    tree = refs.tree
+    own = np.asarray(refs.incidence.todense()) > 0
+    on_path = np.zeros((len(tree), own.shape[1]), dtype=bool)
+    on_path[:tree.n_hgs] = own
+    for level in tree.levels[1:]:
+        on_path[level] |= on_path[tree.parent[level]]
+    return on_path[:tree.n_hgs]
+
+
+def pack_bed_rows(codes):
+    """packs a snps x samples array of two-bit codes into .bed rows"""
+    n_snps, n_samples = codes.shape
+    padded = np.zeros((n_snps, -(-n_samples // 4) * 4), dtype=np.uint8)
+    padded[:, :n_samples] = codes
+    padded = padded.reshape(n_snps, -1, 4) << np.array([0, 2, 4, 6], dtype=np.uint8)
+    return np.bitwise_or.reduce(padded, axis=2).astype(np.uint8)
+
+
+def write_cohort(refs, prefix, n_samples, missing_rate, error_rate, seed=1):
+    """writes a synthetic plink library for n_samples individuals, returning the haplogroup of each individual"""
+    rng = np.random.RandomState(seed)
+    on_path = get_path_incidence(refs)
+    positions = np.asarray(refs.snp_positions)
+
+    # only haplogroups that can be told apart by at least one snp are drawn
+    candidates = np.flatnonzero(on_path.any(axis=1))
+    sample_hgs = candidates[rng.randint(len(candidates), size=n_samples)]
+    sample_ids = ['SYN%07d' % (n) for n in range(n_samples)]
+
+    with open(prefix + '.fam', 'w') as fam:
+        fam.writelines('%s %s 0 0 1 -9\n' % (sample_id, sample_id) for sample_id in sample_ids)
+    with open(prefix + '.bim', 'w') as bim:
+        bim.writelines('24\tsyn%s\t0\t%s\t%s\t%s\n' % (pos, pos, refs.derived_alleles[j], refs.ancestral_alleles[j]) for j, pos in enumerate(positions.tolist()))
+    with open(prefix + '.truth', 'w') as truth:
+        truth.writelines('%s\t%s\n' % (sample_id, refs.tree.names[hg]) for sample_id, hg in zip(sample_ids, sample_hgs.tolist()))
+
+    # A1 is the derived allele and A2 the ancestral allele
+    with open(prefix + '.bed', 'wb') as bed:
+        bed.write(bytearray(BED_MAGIC))
+        for start in range(0, len(positions), SNP_BLOCK):
+            derived = on_path[sample_hgs, start:start + SNP_BLOCK].T
+            flip = rng.random_sample(derived.shape) < error_rate
+            derived ^= flip
+            codes = np.where(derived, BED_HOM_A1, BED_HOM_A2).astype(np.uint8)
+            codes[rng.random_sample(codes.shape) < missing_rate] = BED_MISSING
+            bed.write(pack_bed_rows(codes).tobytes())
+    return sample_hgs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='synthetic_cohort', description='Write a synthetic plink library for benchmarking SNAPPY')
+    parser.add_argument('--n_samples', help='number of individuals', type=int, default=1000, required=False)
+    parser.add_argument('--missing_rate', help='fraction of genotype calls set to missing', type=float, default=0.02, required=False)
+    parser.add_argument('--error_rate', help='fraction of genotype calls switched between derived and ancestral', type=float, default=0.001, required=False)
+    parser.add_argument('--seed', help='random seed', type=int, default=1, required=False)
+    parser.add_argument('--ref_files_dir', help='directory where reference file are stored', type=str, default='ref_files', required=False)
+    parser.add_argument('--out', help='prefix for the plink library', type=str, default='synthetic_cohort', required=False)
+    args = parser.parse_args()
+
+    refs = get_compiled_refs(get_ref_files(args.ref_files_dir, 'id_to_pos.txt', 'pos_to_allele.txt', 'y_hg_and_snps.sort', 'tree_structure.txt'))
+    write_cohort(refs, args.out, args.n_samples, args.missing_rate, args.error_rate, args.seed)
+    print('Wrote %s individuals to %s.bed, .bim, .fam and .truth' % (args.n_samples, args.out))
+    sys.exit()
@@ -8,14 +8,21 @@ setup(name='snappy',
       author_email='jonathan.shortt@cuanschutz.edu',
       license='GPLv3.0',
       packages=['snappy', 'snappy/bin'],
-      install_requires=[ #numpy is only module that is not included in standard distributions of python
-            'numpy>=1.13.3'
+      package_data={'snappy': ['ref_bundle/*']},     #precompiled default references, see snappy/bin/compile_refs.py
+      install_requires=[ #numpy and scipy are the only modules that are not included in standard distributions of python
+            'numpy>=1.13.3',
+            'scipy>=1.0'
       ],
+      extras_require={
+            'parquet': ['pyarrow']     #only needed to write the score matrix as parquet with --scores parquet
+      },
       entry_points = { 'console_scripts': [
       		'snappy=snappy.main:run_snappy', 
             'snappy-clean=snappy.main:clean_isogg_table',
             'snappy-qc=snappy.main:do_isogg_qc',
-            'snappy-build=snappy.main:make_ref_files'
+            'snappy-build=snappy.main:make_ref_files',
+            'snappy-compile-refs=snappy.main:compile_ref_files',
+            'snappy-serve=snappy.main:serve_snappy'
         ],
       },
       zip_safe=False)
@@ -1,4 +1,25 @@
-from .bin.SNAPPY import snappy
-from .bin.clean_isogg import clean_isogg
-from .bin.isogg_qc import isogg_qc
-from .bin.make_snappy_refs import make_snappy_refs
+"""
+tools are imported when they are first used, so that each command only pays for importing what it needs
+"""
+
+import importlib
+
+_TOOLS = {
+    'snappy': '.bin.SNAPPY',
+    'clean_isogg': '.bin.clean_isogg',
+    'isogg_qc': '.bin.isogg_qc',
+    'make_snappy_refs': '.bin.make_snappy_refs',
+    'compile_refs': '.bin.compile_refs',
+    'Classifier': '.bin.classifier',
+    'serve': '.bin.serve',
+}
+
+__all__ = list(_TOOLS)
+
+
+def __getattr__(name):
+    if name not in _TOOLS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module(_TOOLS[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -7,202 +7,568 @@ This script takes chrY data in plink format (.bim, .bed, .fam) and produces hapl
 import os
 import os.path
 import sys
-import subprocess
-from snappy import *
+import contextlib
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+import numpy as np
 from snappy.bin.parse_ref_files import *        #these two lines aren't clean-looking but they do at least seem to work
 from snappy.bin.parse_plink_files import *
+from snappy.bin.hg_tree import *
+from snappy.bin.compile_refs import get_refs
+from snappy.bin.parse_vcf_files import read_vcf_genotypes, iter_vcf_chunks
+from snappy.bin.result_cache import ResultCache
+from snappy.bin.run_metrics import RunMetrics, timed, count_unused_markers, profiled
+from snappy.bin import score_matrix
+from snappy.bin.score_matrix import SCORE_FORMATS, open_score_writer, get_score_matrix_file
 import argparse
 
-def count_define_called_snps(subgroup_snps, pos_to_gt, isogg_id_to_pos):
-    """counts how many defining snps are actually called"""
-    total = 0
-    for snp in subgroup_snps:
-        # if multiple ids for the same snp, tests until finds one with position
-        if '/' in snp:
-            candidates = snp.split('/')
-            for candidate in candidates:
-                if candidate in isogg_id_to_pos:
-                    snp = candidate
-                    break
-        # if the snp is genotyped, count it
-        if snp in isogg_id_to_pos:
-            pos = isogg_id_to_pos[snp]
-            if pos in pos_to_gt:
-                gt = pos_to_gt[pos]
-                if gt != 'N':
-                    total += 1
-    return float(total)
-
-
-def get_parent_hg(hg_to_parent, hg):
-    """returns the parental haplogroup"""
-    if hg in hg_to_parent:
-        return hg_to_parent[hg]
-    elif hg in ['A0-T', 'A00']:
-        return ''
-    else:
-        return hg[:-1]
+# .all lines are formatted for a whole chunk of samples and written through a large buffer
+WRITE_BUFFER_SIZE = 1 << 20
 
+# messages printed for individuals, by the codes stored in the result cache
+NO_MATCH_MESSAGE = 'No match: %s'
+ROOT_MESSAGE = '%s: No supported leaf haplogroup available. Assigning default root haplogroup A0-T. See .all file for best assignments.'
+SAMPLE_MESSAGES = {1: NO_MATCH_MESSAGE, 2: ROOT_MESSAGE}
 
-def has_parent_calls(hg, sample, scores, names, parent_dict, ancestral_hg_depth):
-    """check if at least the parent or grandparent hg has a derived genotype"""
-    count_present = 0   # keeps track of whether parent or grandparent hg is derived
-    for i in range(ancestral_hg_depth):
-        hg = get_parent_hg(parent_dict, hg)     # get parental hg
-        if hg in names:
-            hg_index = names.index(hg)
-            if scores[sample, hg_index] > 0:    # check if hg snps are derived
-                count_present += 1
+def has_parent_calls(hg_scores, tree, ancestral_hg_depth):
+    """for every sample and hg, check if at least the parent or grandparent hg has a derived genotype"""
+    parent_calls = np.zeros(hg_scores.shape, dtype=bool)
+    for ancestors in tree.ancestors[:tree.n_hgs, :ancestral_hg_depth].T:
+        scored = (ancestors >= 0) & (ancestors < tree.n_hgs)     # ancestors that are not reference hgs have no snps
+        parent_calls[:, scored] |= hg_scores[:, ancestors[scored]] > 0
+    return parent_calls
 
-    if count_present > 0:
-        return True
-    else:
-        return False
 
+def sum_down_tree(counts, tree):
+    """for every sample, add the counts of each hg to those of all its ancestral hgs, one tree level at a time"""
+    path_counts = np.zeros((counts.shape[0], len(tree)))
+    path_counts[:, :tree.n_hgs] = counts
+    for level in tree.levels[1:]:
+        path_counts[:, level] += path_counts[:, tree.parent[level]]
+    return path_counts[:, :tree.n_hgs]
+
+
+def score_all_hgs(hg_scores, hg_called, tree):
+    """
+    score every hg for all individuals at once using the counts recorded in hg_score and hg_called, calculate what
+    fraction of snps and ancestral snps are derived, before hgs are limited to those with derived ancestors
+    """
+    n_called_snps = sum_down_tree(hg_scores, tree)     # count number of derived snps in hg and all ancestral hgs
+    n_defining_snps = sum_down_tree(hg_called, tree)
+    scored = (hg_scores > 0) & (n_defining_snps > 0)
+    all_hg_scores = np.zeros(hg_scores.shape)       # score all hgs
+    all_hg_scores[scored] = n_called_snps[scored] / n_defining_snps[scored]
+    return all_hg_scores
 
-def get_ancestry(hg, parent_dict):
-    """create list of all parent haplogroups"""
-    hg = get_parent_hg(parent_dict, hg)
-    ancestors = []
-    while hg:
-        ancestors.append(hg)
-        hg = get_parent_hg(parent_dict, hg)
 
-    return ancestors
+def select_scored_hgs(all_hg_scores, hg_scores, tree, ancestral_hg_depth):
+    """only score hgs with derived parent or grandparent hg, unless no hg qualifies for the individual"""
+    strict_hg_scores = np.where(has_parent_calls(hg_scores, tree, ancestral_hg_depth), all_hg_scores, 0)
+    use_strict = (strict_hg_scores > 0).any(axis=1)
+    return np.where(use_strict[:, np.newaxis], strict_hg_scores, all_hg_scores)
 
 
-def score_hgs(hg_scores, hg_to_snps, genotypes, n, issog_id_to_pos, group_to_parent, ancestral_hg_depth):
+def score_hgs(hg_scores, hg_called, tree, ancestral_hg_depth):
     """
-    score every hg for an individual using the counts recorded in hg_score, calculate what fraction of snps and
-    ancestral snps are derived
+    score every hg for all individuals at once, returning a samples x hgs array where unscored hgs are zero
     """
-    hg_names = list(hg_to_snps.keys())
-    strict_hg_to_score = dict()     # only score hgs with derived parent or grandparent hg
-    all_hg_to_score = dict()        # score all hgs
-    for h in range(len(hg_names)):
-        hg_score = hg_scores[n, h]  # get number of derived calls for hg snps
-        if hg_score > 0:
-            hg = hg_names[h]
-            n_called_snps = 0
-            n_defining_snps = 0
-            while hg:               # count number of derived snps in hg and all ancestral hgs
-                if hg in hg_names:
-                    n_called_snps += hg_scores[n, hg_names.index(hg)]
-                    n_defining_snps += count_define_called_snps(hg_to_snps[hg], genotypes[n], issog_id_to_pos)
-
-                hg = get_parent_hg(group_to_parent, hg)
-
-            # record hg score
-            if n_defining_snps > 0:
-                all_hg_to_score[hg_names[h]] = n_called_snps / float(n_defining_snps)
-                if has_parent_calls(hg_names[h], n, hg_scores, hg_names, group_to_parent, ancestral_hg_depth):
-                    strict_hg_to_score[hg_names[h]] = n_called_snps / float(n_defining_snps)
-
-    # return hg scores
-    if list(strict_hg_to_score.keys()):
-        return strict_hg_to_score
-    else:
-        return all_hg_to_score
+    return select_scored_hgs(score_all_hgs(hg_scores, hg_called, tree), hg_scores, tree, ancestral_hg_depth)
 
 
-def pick_leaf(hg_to_score, group_to_parent, outfile, sample_id, min_hap_score, min_deep_score, hg_to_snps, trunc_haps):
+def pick_leaf(all_scores, tree, min_hap_score, min_deep_score):
     """
-    of the non-zero scored haplogroups collect all of the leaves, ie those which are not ancestral to any other
-    non-zero haplogroup. Then, choose the group with the highest score and longest name
+    for all individuals at once, collect the leaves among the haplogroups scoring at least min_hap_score, ie those with
+    no such haplogroup below them in the tree. Then, choose the leaf with the highest score, or the leaf with the
+    longest name if it scores at least min_deep_score. Returns the chosen hg for each individual (A0-T when there is no
+    leaf), its score, and whether a leaf was found. Ties go to the hg listed first in the reference
     """
-    
-    candidates = list(hg_to_score.keys())
-    if not candidates:  # no hg matches, likely a poor quality sample
-        print(('No match: ' + sample_id))
-        outfile.write(sample_id + '\tno match\n')
-        return
-
-    leaves = set()											# leaves is now a set instead of list
-    for candidate in candidates:
-    	c_ancestors = get_ancestry(candidate, group_to_parent)
-    	if hg_to_score[candidate] >= min_hap_score and c_ancestors:     # check if hg score is high enough and is not the root
-    		is_leaf = True
-    		bad_leaves = []
-    		for leaf in leaves:
-    			l_ancestors = get_ancestry (leaf, group_to_parent)
-    			if candidate in l_ancestors:
-    				is_leaf = False
-    			if leaf in c_ancestors:
-    				bad_leaves.append(leaf)
-    		for bad_leaf in bad_leaves:
-    			leaves.discard(bad_leaf)
-    		if is_leaf:
-    			leaves.add(candidate)
-            
-    max_leaf = 'A0-T'
-    max_score = 0
-    try:
-    	max_score = hg_to_score[max_leaf]
-    except:
-    	max_score = 0
-    if leaves: # find leaf with highest hg score
-    	# just initializing variable
-    	max_leaf = list(leaves)[0]
-    	max_score = hg_to_score[max_leaf]
-    	for leaf in leaves:
-    		if max_score < hg_to_score[leaf]:
-    			max_leaf = leaf
-    			max_score = hg_to_score[leaf]
-    	# check if there is a more derived leaf with a high score
-    	longest_leaf = max(leaves, key=len)
-    	if len(max_leaf) < len(longest_leaf) and hg_to_score[longest_leaf] >= min_deep_score:
-    		max_leaf = longest_leaf
-    		max_score = hg_to_score[longest_leaf]
+    n_samples = all_scores.shape[0]
+    qualifying = np.zeros((n_samples, len(tree)), dtype=bool)      # check if hg score is high enough and is not the root
+    qualifying[:, :tree.n_hgs] = (all_scores > 0) & (all_scores >= min_hap_score) & (tree.parent[:tree.n_hgs] >= 0)
+
+    # count qualifying descendants of every hg from prefix sums in euler tour order, where a subtree is an interval
+    in_tour_order = np.zeros((n_samples, len(tree) + 1), dtype=np.int32)
+    np.cumsum(qualifying[:, np.argsort(tree.tin)], axis=1, out=in_tour_order[:, 1:])
+    n_descendants = in_tour_order[:, tree.tout] - in_tour_order[:, tree.tin + 1]
+    leaves = qualifying[:, :tree.n_hgs] & (n_descendants[:, :tree.n_hgs] == 0)
+    has_leaf = leaves.any(axis=1)
+
+    # find leaf with highest hg score, then check if there is a more derived leaf with a high score
+    samples = np.arange(n_samples)
+    max_leaf = np.argmax(np.where(leaves, all_scores, -1), axis=1)
+    name_length = np.array([len(hg) for hg in tree.names[:tree.n_hgs]])
+    longest_leaf = np.argmax(np.where(leaves, name_length, -1), axis=1)
+    go_deeper = has_leaf & (name_length[max_leaf] < name_length[longest_leaf]) & (all_scores[samples, longest_leaf] >= min_deep_score)
+    max_leaf = np.where(go_deeper, longest_leaf, max_leaf)
+
+    # without a leaf, assign the root
+    root = tree.index.get('A0-T', -1)
+    max_leaf[~has_leaf] = root
+    max_score = np.where(max_leaf >= 0, all_scores[samples, max_leaf], 0)
+    return max_leaf, max_score, has_leaf
+
+
+def get_leaf_line(sample_id, scores, max_leaf, max_score, has_leaf, tree, min_hap_score, hg_to_snps, trunc_haps):
+    """returns the .out line for the haplogroup assigned to one individual, and a message to print or None"""
+    if not scores.any():  # no hg matches, likely a poor quality sample
+        return sample_id + '\tno match\n', NO_MATCH_MESSAGE % (sample_id)
+
+    message = None
+    max_leaf = tree.names[max_leaf] if max_leaf >= 0 else 'A0-T'
     # might be better to issue a warning, then just make assignment to highest score that is most derived, or create option to just assign as root	
-    elif max_score < min_hap_score:
-    	print('%s: No supported leaf haplogroup available. Assigning default root haplogroup A0-T. See .all file for best assignments.' % (sample_id))    
+    if not has_leaf and max_score < min_hap_score:
+    	message = ROOT_MESSAGE % (sample_id)
     assign_hg = trunc_haps[max_leaf]    
     # write to output file
     hg_snps = ','.join(hg_to_snps[max_leaf])		#still showing markers for haplogroup, not the trunated haplogroup
-    outfile.write('%s\t%s\t%s\t%s\n' % (sample_id, assign_hg, str(round(max_score, 3)), hg_snps))
-
+    score = str(round(max_score, 3)) if max_score else '0'     # unscored root
+    return '%s\t%s\t%s\t%s\n' % (sample_id, assign_hg, score, hg_snps), message
 
-def get_all_subgroups(hg_to_score, fi, sample_id):
-    """record all non-zero scored haplogroups as a reference"""
-    top_candidates = []
-    candidate_scores = []
-    all_scores = list(hg_to_score.values())
-    while all_scores:       # order hgs based on score
-        max_score = max(all_scores)
 
-        candidates = []
-        for hg in hg_to_score:
-            if hg_to_score[hg] == max_score:
-                candidates.append(hg)
-
-        candidates.sort(key=len)
-        candidates.reverse()
+def get_all_floors(all_scores, top_k=None, min_score=0):
+    """
+    returns, for every sample, the lowest score listed in its .all line: min_score, raised to the top_k-th highest
+    score of the sample when top_k is given. The top_k-th score is found by partial selection, without ranking
+    """
+    floors = np.full(all_scores.shape[0], float(min_score))
+    if top_k is not None and top_k < all_scores.shape[1]:
+        kth_scores = -np.partition(-all_scores, top_k - 1, axis=1)[:, top_k - 1]
+        floors = np.maximum(floors, kth_scores)
+    return floors
 
-        for candidate in candidates:
-            top_candidates.append(candidate)
-            candidate_scores.append(max_score)
 
-        while max_score in all_scores:
-            all_scores.remove(max_score)
+def get_all_subgroups(scores, hg_names, sample_id, floor=0, top_k=None):
+    """
+    record all non-zero scored haplogroups as a reference, returns the line for the .all file. Only haplogroups
+    scoring at least floor are ranked, and at most top_k are listed
+    """
+    # order hgs by score, then by name length, both descending; equal hgs keep the reverse of reference order
+    scored = np.flatnonzero(scores >= floor if floor > 0 else scores)[::-1].tolist()
+    exact_scores = scores.tolist()
+    ranked = sorted(scored, key=lambda h: (-exact_scores[h], -len(hg_names[h])))
+    if top_k is not None:
+        ranked = ranked[:top_k]      # hgs tied with the top_k-th score are cut in ranked order
 
     # write hgs and scores to output
-    line = []
-    for i in range(len(top_candidates)):
-        line.append(top_candidates[i] + ':' + str(round(candidate_scores[i], 3)))
-    fi.write(str(sample_id) + '\t' + '\t'.join(line) + '\n')
+    rounded_scores = np.round(scores, 3).tolist()
+    line = [hg_names[h] + ':' + str(rounded_scores[h]) for h in ranked]
+    return str(sample_id) + '\t' + '\t'.join(line) + '\n'
 
-def assign_subgroups(path, group_to_parent, samples, hg_scores, hg_to_snps, genotypes, issog_id_to_pos, sample_id, min_hap_score , min_deep_score, out_prefix, ancestral_hg_depth, trunc_haps):
-    """For a sample, score all the hgs based on # derived alleles, then assign hg"""
+def assign_chunk(sample_id, genotypes, tree, incidence, hg_to_snps, trunc_haps, min_hap_score, min_deep_score, ancestral_hg_depth,
+                 write_all=True, keep_scores=False, all_top_k=None, all_min_score=0, metrics=None):
+    """
+    tally the defining snps of a chunk of samples, score all the hgs based on # derived alleles, then assign hg.
+    Returns the .out lines, the .all lines (none without write_all) and the messages for the chunk, in sample order,
+    and with keep_scores the samples x hgs arrays of scores, derived and called snps, or otherwise None. .all lines
+    list at most all_top_k hgs, scoring at least all_min_score
+    """
+    # use genotype calls to track number of derived and called snps for a hg
+    with timed(metrics, 'tally'):
+        hg_scores, hg_called = tally_defining_snps(genotypes, incidence)
+    with timed(metrics, 'scoring'):
+        all_scores = score_hgs(hg_scores, hg_called, tree, ancestral_hg_depth)
+    with timed(metrics, 'leaf_picking'):
+        max_leaf, max_score, has_leaf = pick_leaf(all_scores, tree, min_hap_score, min_deep_score)
+    leaf_lines = []
+    all_lines = []
+    messages = []
+    with timed(metrics, 'formatting'):
+        if write_all:
+            all_floors = get_all_floors(all_scores, all_top_k, all_min_score)
+        for n in range(len(sample_id)):
+            line, message = get_leaf_line(sample_id[n], all_scores[n], max_leaf[n], max_score[n], has_leaf[n], tree, min_hap_score, hg_to_snps, trunc_haps)
+            leaf_lines.append(line)
+            if message:
+                messages.append(message)
+            if write_all:
+                all_lines.append(get_all_subgroups(all_scores[n], tree.names, sample_id[n], all_floors[n], all_top_k))
+    scores = (all_scores, hg_scores, hg_called) if keep_scores else None
+    return leaf_lines, all_lines, messages, scores
+
+
+# reference and parameters of a scoring process, set once when the process starts
+worker_state = dict()
+
+def init_worker(state):
+    worker_state.update(state)
+
+
+def assign_shared_block(block):
+    """assign hgs for a block of samples whose genotypes are read from the shared, memory-mapped genotype matrix"""
+    shared_file, shape, start, stop, sample_id = block
+    genotypes = np.memmap(shared_file, dtype=np.int8, mode='r', shape=shape)
+    return assign_chunk(sample_id, genotypes[start:stop], **worker_state)
+
+
+def assign_chunk_parallel(pool, processes, shared_file, sample_id, genotypes):
+    """
+    splits a chunk of samples across a process pool. The genotype matrix is written once to a memory-mapped file
+    (in /dev/shm where available) that every process maps, rather than being pickled to each process
+    """
+    shared = np.memmap(shared_file, dtype=np.int8, mode='w+', shape=genotypes.shape)
+    shared[:] = genotypes
+    shared.flush()
+    del shared
+    block_size = -(-len(sample_id) // (processes * 4))     # several blocks per process to even out the load
+    blocks = [(shared_file, genotypes.shape, start, start + block_size, sample_id[start:start + block_size]) for start in range(0, len(sample_id), block_size)]
+    leaf_lines = []
+    all_lines = []
+    messages = []
+    block_scores = []
+    for block_leaf_lines, block_all_lines, block_messages, scores in pool.imap(assign_shared_block, blocks):     # results come back in sample order
+        leaf_lines.extend(block_leaf_lines)
+        all_lines.extend(block_all_lines)
+        messages.extend(block_messages)
+        block_scores.append(scores)
+    if block_scores[0] is None:
+        return leaf_lines, all_lines, messages, None
+    return leaf_lines, all_lines, messages, tuple(np.concatenate(arrays) for arrays in zip(*block_scores))
+
+
+def assign_chunk_cached(sample_id, genotypes, result_cache, assign):
+    """
+    assigns hgs to a chunk of samples, reusing cached results for genotypes scored before. Only the other samples are
+    passed to assign, and their results are added to the cache
+    """
+    keys = result_cache.get_keys(genotypes)
+    cached = result_cache.get(keys)
+    todo = dict()       # samples with identical genotypes are scored once
+    for n in range(len(sample_id)):
+        if keys[n] not in cached and keys[n] not in todo:
+            todo[keys[n]] = n
+    todo = list(todo.values())
+    result_cache.hits += len(sample_id) - len(todo)
+    result_cache.misses += len(todo)
+    if todo:
+        todo_ids = [sample_id[n] for n in todo]
+        leaf_lines, all_lines, messages = assign(todo_ids, genotypes[todo])[:3]
+        messages = set(messages)
+        new_rows = []
+        for k in range(len(todo)):
+            n = todo[k]
+            prefix_length = len(sample_id[n]) + 1
+            message = next((code for code in SAMPLE_MESSAGES if SAMPLE_MESSAGES[code] % (sample_id[n]) in messages), 0)
+            all_line = all_lines[k][prefix_length:] if all_lines else ''
+            cached[keys[n]] = (leaf_lines[k][prefix_length:], all_line, message)
+            new_rows.append((keys[n], leaf_lines[k][prefix_length:], all_line, message))
+        result_cache.put(new_rows)
+
+    leaf_lines = []
+    all_lines = []
+    messages = []
+    for n in range(len(sample_id)):
+        leaf_line, all_line, message = cached[keys[n]]
+        leaf_lines.append(sample_id[n] + '\t' + leaf_line)
+        if all_line:
+            all_lines.append(sample_id[n] + '\t' + all_line)
+        if message:
+            messages.append(SAMPLE_MESSAGES[message] % (sample_id[n]))
+    return leaf_lines, all_lines, messages, None
+
+
+def read_checkpoint(checkpoint_file):
+    """returns the checkpoint of an earlier run, or None if there is none"""
+    if not os.path.isfile(checkpoint_file):
+        return None
+    with open(checkpoint_file, 'r') as infp:
+        return json.load(infp)
+
+
+def write_checkpoint(checkpoint_file, checkpoint):
+    """replaces the checkpoint file atomically, so a crash leaves either the old or the new checkpoint"""
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'w') as outfp:
+        json.dump(checkpoint, outfp)
+        outfp.flush()
+        os.fsync(outfp.fileno())
+    os.replace(tmp_file, checkpoint_file)
+
+
+def skip_done_samples(genotype_chunks, n_done, last_sample):
+    """drops the samples finished by an earlier run, checking that the input lists the same samples up to that point"""
+    for sample_id, genotypes in genotype_chunks:
+        if n_done:
+            n_skip = min(n_done, len(sample_id))
+            skipped = sample_id[n_skip - 1]
+            sample_id = sample_id[n_skip:]
+            genotypes = genotypes[n_skip:]
+            n_done -= n_skip
+            if not n_done and skipped != last_sample:
+                print('Unable to resume: the input does not list the samples of the earlier run (expected %s, found %s). Rerun without --resume' % (last_sample, skipped))
+                sys.exit()
+            if not len(sample_id):
+                continue
+        yield sample_id, genotypes
+    if n_done:
+        print('Unable to resume: the input has fewer samples than the earlier run. Rerun without --resume')
+        sys.exit()
+
+
+def assign_subgroups(path, tree, genotype_chunks, incidence, hg_to_snps, min_hap_score , min_deep_score, out_prefix, ancestral_hg_depth, trunc_haps, processes=1, resume=False, settings=None, result_cache=None, metrics=None,
+                     write_all=True, scores_format=None, all_top_k=None, all_min_score=0):
+    """
+    For each chunk of samples, score all the hgs based on # derived alleles, then assign hg. Results are appended to
+    the .out and .all files as each chunk is finished, and a checkpoint records how many samples and bytes of output
+    are complete; it is removed once every sample is assigned. With resume, an interrupted run picks up from the
+    checkpoint. With more than one process, samples are split
+    across a pool. With a result cache, samples whose genotypes were scored before are not scored again. With
+    metrics, the time spent in each stage is recorded. With scores_format, the samples x hgs score matrix is also
+    written in columnar form; without write_all, no .all file is written. all_top_k and all_min_score limit the hgs
+    listed in the .all file
+    """
     print('\nNow finding best-supported haplogroup for each individual')
     print('Minimum considered haplogroup score = %s' % (min_hap_score))
     print('Minimum switch to deeper node score (min_deep_score) = %s' % (min_deep_score))
+    out_file = path + '/' + out_prefix + '.out'
+    all_file = path + '/' + out_prefix + '.all'
+    scores_file = get_score_matrix_file(path + '/' + out_prefix, scores_format) if scores_format else None
+    checkpoint_file = path + '/' + out_prefix + '.ckpt'
+    checkpoint = {'settings': settings, 'n_samples': 0, 'last_sample': None, 'out_bytes': 0, 'all_bytes': 0}
+
+    # pick up where an earlier run with the same settings stopped, dropping output written after its last checkpoint
+    mode = 'w'
+    if resume:
+        done = read_checkpoint(checkpoint_file)
+        if done is None or not all(os.path.exists(filename) for filename in (out_file, write_all and all_file, scores_file) if filename):
+            print('No checkpoint found for "%s", starting from the first sample' % (out_prefix))
+        elif done['settings'] != settings:
+            print('Unable to resume: %s was written with different input or settings. Rerun without --resume' % (checkpoint_file))
+            sys.exit()
+        elif scores_format == 'parquet':
+            print('Unable to resume: a parquet score matrix cannot be continued. Rerun without --resume, or with --scores npy')
+            sys.exit()
+        else:
+            print('Resuming after %s individuals (last completed sample %s)' % (done['n_samples'], done['last_sample']))
+            checkpoint = done
+            os.truncate(out_file, done['out_bytes'])
+            if write_all:
+                os.truncate(all_file, done['all_bytes'])
+            genotype_chunks = skip_done_samples(genotype_chunks, done['n_samples'], done['last_sample'])
+            mode = 'a'
+
+    state = {'tree': tree, 'incidence': incidence, 'hg_to_snps': hg_to_snps, 'trunc_haps': trunc_haps, 'min_hap_score': min_hap_score,
+             'min_deep_score': min_deep_score, 'ancestral_hg_depth': ancestral_hg_depth, 'write_all': write_all, 'keep_scores': scores_format is not None,
+             'all_top_k': all_top_k, 'all_min_score': all_min_score}
+    pool = None
+    if processes > 1:
+        print('Scoring samples with %s processes' % (processes))
+        pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(state,))
+        shared_dir = tempfile.mkdtemp(prefix='snappy_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        shared_file = os.path.join(shared_dir, 'genotypes.int8')
+
+    def score_chunk(sample_id, genotypes):
+        if pool is not None and len(sample_id) > 1:
+            # tally, scoring and leaf picking happen in the pool, so are timed together
+            with timed(metrics, 'parallel_scoring'):
+                return assign_chunk_parallel(pool, processes, shared_file, sample_id, genotypes)
+        return assign_chunk(sample_id, genotypes, metrics=metrics, **state)
+
     # score all hgs, then use to assign hg to individual
-    with open(path + '/' + out_prefix + '.out', 'w') as leaf_outfile, open(path + '/' + out_prefix + '.all', 'w') as all_outfile:
-        print('\nPrinting results to .out and .all with prefix "%s"' % (out_prefix))
-        for n in range(samples):
-            hg_to_score = score_hgs(hg_scores, hg_to_snps, genotypes, n, issog_id_to_pos, group_to_parent, ancestral_hg_depth)
-            pick_leaf(hg_to_score, group_to_parent, leaf_outfile, sample_id[n], min_hap_score , min_deep_score, hg_to_snps, trunc_haps)
-            get_all_subgroups(hg_to_score, all_outfile, sample_id[n])
+    n_individuals = 0
+    try:
+        with contextlib.ExitStack() as outfiles:
+            leaf_outfile = outfiles.enter_context(open(out_file, mode))
+            all_outfile = outfiles.enter_context(open(all_file, mode, buffering=WRITE_BUFFER_SIZE)) if write_all else None
+            score_writer = None
+            if scores_format:
+                score_writer = open_score_writer(path + '/' + out_prefix, scores_format, tree.names[:tree.n_hgs], checkpoint['n_samples'] if mode == 'a' else None)
+                outfiles.callback(score_writer.close)
+            print('\nPrinting results with prefix "%s" to %s' % (out_prefix, ', '.join(os.path.basename(filename) for filename in (out_file, write_all and all_file, scores_file) if filename)))
+            if mode == 'w':
+                write_checkpoint(checkpoint_file, checkpoint)
+            if metrics is not None:
+                genotype_chunks = metrics.iter_stage(genotype_chunks, 'decode')
+            for sample_id, genotypes in genotype_chunks:
+                start = time.time()
+                if result_cache is not None:
+                    leaf_lines, all_lines, messages, scores = assign_chunk_cached(sample_id, genotypes, result_cache, score_chunk)
+                else:
+                    leaf_lines, all_lines, messages, scores = score_chunk(sample_id, genotypes)
+                if metrics is not None:
+                    metrics.add_samples(len(sample_id), time.time() - start)
+                for message in messages:
+                    print(message)
+                with timed(metrics, 'output'):
+                    leaf_outfile.writelines(leaf_lines)
+                    if all_outfile is not None:
+                        all_outfile.writelines(all_lines)
+                    if score_writer is not None:
+                        score_writer.append(sample_id, *scores)
+                        score_writer.flush()
+                    # results must reach the disk before the checkpoint says they are complete
+                    for outfile in (leaf_outfile, all_outfile):
+                        if outfile is not None:
+                            outfile.flush()
+                            os.fsync(outfile.fileno())
+                    n_individuals += len(sample_id)
+                    checkpoint['n_samples'] += len(sample_id)
+                    checkpoint['last_sample'] = sample_id[-1]
+                    checkpoint['out_bytes'] = os.fstat(leaf_outfile.fileno()).st_size
+                    if all_outfile is not None:
+                        checkpoint['all_bytes'] = os.fstat(all_outfile.fileno()).st_size
+                    write_checkpoint(checkpoint_file, checkpoint)
+        # a finished run leaves only its output behind
+        os.remove(checkpoint_file)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            shutil.rmtree(shared_dir, ignore_errors=True)
+    print('Assigned haplogroups for %s individuals' % (n_individuals))
+    if result_cache is not None:
+        print('Reused cached results for %s individuals and scored %s' % (result_cache.hits, result_cache.misses))
+        if metrics is not None:
+            metrics.count('result_cache_hits', result_cache.hits)
+            metrics.count('result_cache_misses', result_cache.misses)
+
+SWEEP_PARAMETERS = {'min_hap_score': float, 'min_deep_score': float, 'ancestral_hg_depth': int}
+
+
+def parse_sweep_values(name, value):
+    """returns the values of parameter name listed by one value or start:stop:step range of a sweep, or None if it is not valid"""
+    to_value = SWEEP_PARAMETERS[name]
+    try:
+        bounds = [float(v) for v in value.split(':')]
+    except ValueError:
+        return None
+    if not np.all(np.isfinite(bounds)):
+        return None
+    if len(bounds) == 3:
+        start, stop, step = bounds
+        if step <= 0 or stop < start:
+            return None
+        # values run from start up to stop; a step that does not divide the range stops short of stop
+        n_values = int(np.floor((stop - start) / step + 1e-9)) + 1
+        swept = [round(start + k * step, 10) for k in range(n_values)]
+        if abs(swept[-1] - stop) > 1e-9:
+            print('Warning: a step of %s does not divide the sweep range %s:%s of %s, so its last value is %s' % (step, start, stop, name, swept[-1]))
+    elif len(bounds) == 1:
+        swept = bounds
+    else:
+        return None
+    if to_value is int and any(v != int(v) for v in swept):
+        return None
+    return [to_value(v) for v in swept]
+
+
+def parse_sweep(spec, defaults):
+    """
+    parses a sweep such as "min_hap_score=0.6,0.7,0.75;min_deep_score=0.8:0.95:0.05" into a list of settings, one
+    for each combination of values. Ranges are start:stop:step, with no value past stop and stop included when the
+    step divides the range; parameters that are not swept keep their default value
+    """
+    values = dict((name, [defaults[name]]) for name in SWEEP_PARAMETERS)
+    for item in spec.split(';'):
+        if not item.strip():
+            continue
+        name, _, listed = item.partition('=')
+        name = name.strip().lstrip('-')
+        if name not in SWEEP_PARAMETERS or not listed.strip():
+            print('Unable to parse sweep "%s". Sweeps list values for %s, eg. min_hap_score=0.6,0.7;ancestral_hg_depth=1:3:1' % (item, ', '.join(SWEEP_PARAMETERS)))
+            sys.exit()
+        values[name] = []
+        for value in listed.split(','):
+            swept = parse_sweep_values(name, value)
+            if not swept:
+                print('Unable to parse sweep value "%s" for %s. Give a %s, or a range start:stop:step with a positive step and stop no less than start, eg. %s' % (value, name, 'whole number' if SWEEP_PARAMETERS[name] is int else 'number', '1:3:1' if SWEEP_PARAMETERS[name] is int else '0.6:0.8:0.05'))
+                sys.exit()
+            values[name].extend(swept)
+    grid = []
+    for depth in values['ancestral_hg_depth']:
+        for min_hap_score in values['min_hap_score']:
+            for min_deep_score in values['min_deep_score']:
+                grid.append({'min_hap_score': min_hap_score, 'min_deep_score': min_deep_score, 'ancestral_hg_depth': depth})
+    return grid
+
+
+def read_truth(truth_file):
+    """reads reference haplogroups from the first two columns of a tab-separated file, such as an earlier .out file"""
+    truth = dict()
+    with open(truth_file, 'r') as infp:
+        for line in infp:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) > 1 and not line.startswith('#'):
+                truth[fields[0]] = fields[1]
+    return truth
+
+
+def sweep_subgroups(path, tree, genotype_chunks, incidence, hg_to_snps, out_prefix, trunc_haps, grid, truth_file=None, metrics=None):
+    """
+    assigns hgs for every combination of settings in grid, tallying the defining snps of each chunk only once. Writes
+    a long-format table of assignments and a summary for each combination, with agreement against reference
+    haplogroups when a truth file is given, or otherwise against the first combination
+    """
+    print('\nSweeping %s combinations of scoring settings' % (len(grid)))
+    truth = read_truth(truth_file) if truth_file else None
+    depths = sorted(set(settings['ancestral_hg_depth'] for settings in grid))
+    lineages = dict()
+
+    def same_lineage(hg, other):
+        for name in (hg, other):
+            if name not in lineages:
+                lineages[name] = set(tree.get_ancestry(name))
+        return hg == other or hg in lineages[other] or other in lineages[hg]
+
+    summary = [dict(n_samples=0, n_no_match=0, n_compared=0, n_agree=0, n_same_lineage=0) for settings in grid]
+    n_individuals = 0
+    with open(path + '/' + out_prefix + '.sweep.tsv', 'w', buffering=WRITE_BUFFER_SIZE) as sweep_outfile:
+        print('Printing assignments for each combination to %s.sweep.tsv' % (out_prefix))
+        sweep_outfile.write('sample\tmin_hap_score\tmin_deep_score\tancestral_hg_depth\thaplogroup\tscore\n')
+        if metrics is not None:
+            genotype_chunks = metrics.iter_stage(genotype_chunks, 'decode')
+        for sample_id, genotypes in genotype_chunks:
+            start = time.time()
+            with timed(metrics, 'tally'):
+                hg_scores, hg_called = tally_defining_snps(genotypes, incidence)
+            with timed(metrics, 'scoring'):
+                all_hg_scores = score_all_hgs(hg_scores, hg_called, tree)
+                scores_by_depth = dict((depth, select_scored_hgs(all_hg_scores, hg_scores, tree, depth)) for depth in depths)
+            assigned = []
+            for settings in grid:
+                all_scores = scores_by_depth[settings['ancestral_hg_depth']]
+                max_leaf, max_score, has_leaf = pick_leaf(all_scores, tree, settings['min_hap_score'], settings['min_deep_score'])
+                lines = []
+                hgs = []
+                for n in range(len(sample_id)):
+                    line = get_leaf_line(sample_id[n], all_scores[n], max_leaf[n], max_score[n], has_leaf[n], tree, settings['min_hap_score'], hg_to_snps, trunc_haps)[0]
+                    fields = line.rstrip('\n').split('\t')
+                    hgs.append(fields[1])
+                    lines.append('%s\t%s\t%s\t%s\t%s\t%s\n' % (sample_id[n], settings['min_hap_score'], settings['min_deep_score'], settings['ancestral_hg_depth'],
+                                                             fields[1], fields[2] if len(fields) > 2 else ''))
+                sweep_outfile.writelines(lines)
+                assigned.append(hgs)
+            if metrics is not None:
+                metrics.add_samples(len(sample_id), time.time() - start)
+
+            # agreement with the reference haplogroups, or with the first combination
+            reference = [truth.get(sample) for sample in sample_id] if truth is not None else assigned[0]
+            for counts, hgs in zip(summary, assigned):
+                counts['n_samples'] += len(hgs)
+                for hg, reference_hg in zip(hgs, reference):
+                    if hg == 'no match':
+                        counts['n_no_match'] += 1
+                    if reference_hg is None:
+                        continue
+                    counts['n_compared'] += 1
+                    if hg == reference_hg:
+                        counts['n_agree'] += 1
+                        counts['n_same_lineage'] += 1
+                    elif hg != 'no match' and reference_hg != 'no match' and same_lineage(hg, reference_hg):
+                        counts['n_same_lineage'] += 1
+            n_individuals += len(sample_id)
+
+    with open(path + '/' + out_prefix + '.sweep_summary.tsv', 'w') as summary_outfile:
+        print('Printing agreement for each combination to %s.sweep_summary.tsv' % (out_prefix))
+        summary_outfile.write('min_hap_score\tmin_deep_score\tancestral_hg_depth\tn_samples\tn_no_match\tn_compared\tn_agree\tfrac_agree\tn_same_lineage\tfrac_same_lineage\n')
+        for settings, counts in zip(grid, summary):
+            n_compared = float(max(counts['n_compared'], 1))
+            summary_outfile.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (settings['min_hap_score'], settings['min_deep_score'], settings['ancestral_hg_depth'],
+                                  counts['n_samples'], counts['n_no_match'], counts['n_compared'], counts['n_agree'], round(counts['n_agree'] / n_compared, 4),
+                                  counts['n_same_lineage'], round(counts['n_same_lineage'] / n_compared, 4)))
+    print('Swept %s combinations for %s individuals' % (len(grid), n_individuals))
 
 # was supposed to be a recursive way of adding truncated haplogroup names
 # not currently working, probably not necessary to do it recursively anyway...			        
@@ -225,7 +591,7 @@ def trunc_hap(hg, trunc_haps, group_to_parent):
 		hg = parent_hg
 
 # could be improved with a better haplogroup dictionary- fix in re-write	           
-def get_trunc_haps(haps_file, all_hgs, group_to_parent):
+def get_trunc_haps(haps_file, all_hgs, tree):
 	"""get a list of truncated haplogroup names to use in assignments"""
 	trunc_haps = dict()
 	if haps_file:
@@ -233,12 +599,12 @@ def get_trunc_haps(haps_file, all_hgs, group_to_parent):
 			for line in infp:
 				hap = line.strip()
 				trunc_haps[hap] = hap
-				for parent_hap in get_ancestry(hap, group_to_parent):		#add parents of truncated haplogroups too
+				for parent_hap in tree.get_ancestry(hap):		#add parents of truncated haplogroups too
 					if parent_hap not in trunc_haps:
 						trunc_haps[parent_hap] = parent_hap
 		for hg in all_hgs:		#go through each haplogroup and find its nearest ancestor from the list of truncated haplogroups
 			if hg not in trunc_haps:
-				ancestor_hgs = get_ancestry(hg, group_to_parent)
+				ancestor_hgs = tree.get_ancestry(hg)
 				for parent_hg in ancestor_hgs:
 					if parent_hg in trunc_haps:
 						trunc_haps[hg] = trunc_haps[parent_hg]
@@ -252,59 +618,137 @@ def get_trunc_haps(haps_file, all_hgs, group_to_parent):
 	return trunc_haps
 		
 
+def report_allele_harmonization(site_status, flip_strand, drop_ambiguous, metrics=None):
+	"""prints how the alleles of the .bim snps at reference positions compare with the reference alleles"""
+	counts = np.bincount(site_status, minlength=len(SITE_STATUSES))
+	print('Compared alleles of %s snps at reference positions: %s' % (len(site_status), ', '.join('%s %s' % (n, status) for status, n in zip(SITE_STATUSES, counts.tolist()))))
+	if counts[SITE_STRAND] and not flip_strand:
+		print('%s snps appear to be genotyped on the opposite strand; use --flip_strand to read their alleles from the complementary strand' % (counts[SITE_STRAND]))
+	if drop_ambiguous:
+		print('Left out %s strand-ambiguous (A/T or C/G) snps' % (counts[SITE_AMBIGUOUS]))
+	if metrics is not None:
+		for status, n in zip(SITE_STATUSES, counts.tolist()):
+			metrics.count('bim_snps_' + status, n)
+
+
 def snappy(args):
+	"""assigns hgs, recording metrics for each stage with --metrics and profiling the whole run with --profile"""
+	metrics = RunMetrics() if args.metrics else None
+	if args.profile:
+		with profiled(args.profile):
+			run_snappy_stages(args, metrics)
+	else:
+		run_snappy_stages(args, metrics)
+	if metrics is not None:
+		metrics.write(args.metrics)
+
+
+def run_snappy_stages(args, metrics=None):
 	path = os.getcwd()
 	project_name = args.infile
 	file_prefix = path + '/' + project_name
 	bed = file_prefix + '.bed'
-	vcf = file_prefix + '.vcf'
 	raw = file_prefix + '.raw'
+	vcf = next((file_prefix + suffix for suffix in ('.vcf.gz', '.bcf', '.vcf') if os.path.isfile(file_prefix + suffix)), None)
 
-	# create .raw plink file to interpret genotypes from binary files
+	# read genotypes from a .raw file if one exists, otherwise straight from the binary plink library or vcf
+	use_bed = False
 	if not os.path.isfile(raw):
 		if os.path.isfile(bed):
-			print('Using plink to create .raw file from %s plink library' % (project_name))
-			subprocess.call(['plink', '--bfile', project_name, '--recodeAD', '--out', project_name])
-		elif os.path.isfile(vcf):
-			print('Using plink to create .raw file from vcf %s' % (vcf))
-    		#subprocess.call(['plink', '--vcf', project_name, '--recodeAD', '--out', project_name])
-			subprocess.call(['plink', '--vcf', '%s.vcf' % (project_name), '--recodeAD', '--out', project_name])
+			print('Reading genotypes directly from %s plink library' % (project_name))
+			use_bed = True
+		elif vcf:
+			print('Reading chrY genotypes directly from %s' % (vcf))
 		else:
 			print('Unable to find suitable genotpye files for processing. Please ensure that there is a plink library or vcf with the prefix provided (%s)' % (file_prefix))
+			sys.exit()
 	else:
 		print('Using %s for genotype input' % (raw))
 
-	# build reference dictionaries
-	der_allele_dict = build_derived_allele_dict('%s/%s/%s' % (path, args.ref_files_dir, args.pos2allele) )
-	bim_id_dict, bim_allele_dict = build_bim_id_dict( '%s/%s.bim' % (path, project_name) )
-	hg_snp_dict = build_hg_snp_dict('%s/%s/%s' % (path, args.ref_files_dir, args.hg2snp) )
-	issog_id_dict = build_isogg_id_dict('%s/%s/%s' % (path, args.ref_files_dir, args.id2pos) )
-	
-	# read in structure of tree for non-conforming haplogroup names
-	group_to_parent = getHaploGroup2Parent('%s/%s/%s' % (path, args.ref_files_dir, args.tree_strct))
-
-	# get the genotype calls for each sample
-	genotypes = []
-	sample_ids = []
-	n_individuals = 0
-	with open(raw, 'r') as raw_data:
-		bim_snp_ids = raw_data.readline().rstrip('\n').split(' ')[6:]
-		for line in raw_data:
-			line = line.rstrip('\n').split(' ')
-			sample_id = line[1]
-			sample_ids.append(sample_id)
-
-			data = line[6:]
-			genotype = get_individual_gt(bim_allele_dict, bim_id_dict, bim_snp_ids, data)
-			genotypes.append(genotype)
-			n_individuals += 1
-
-	# use genotype calls to track number of derived snps called for a hg
-	haplogroup_score, hg_snp_dict = tally_defining_snps(n_individuals, genotypes, hg_snp_dict, issog_id_dict, der_allele_dict)
-
-	trunc_haps = get_trunc_haps(args.truncate_haps, list(hg_snp_dict.keys()), group_to_parent)
+	# load the compiled reference, parsing and caching the reference files the first time they are used
+	with timed(metrics, 'reference_load'):
+		ref_files_dir = '%s/%s' % (path, args.ref_files_dir) if args.ref_files_dir else None
+		refs = get_refs(ref_files_dir, args.id2pos, args.pos2allele, args.hg2snp, args.tree_strct, '' if args.no_ref_cache else args.ref_cache_dir)
+		ref_index = refs.ref_index
+
+	if vcf and not use_bed and not os.path.isfile(raw):
+		# only the records at reference positions are read, and decoded straight into the genotype matrix
+		with timed(metrics, 'decode'):
+			sample_ids, vcf_genotypes, genotyped = read_vcf_genotypes(vcf, refs.pos_to_alleles, ref_index, args.ref_fasta)
+		genotype_chunks = iter_vcf_chunks(sample_ids, vcf_genotypes, args.chunk_size)
+	else:
+		# work out allele orientation once per .bim column
+		with timed(metrics, 'allele_orientation'):
+			bim_ids, bim_pos, bim_a1, bim_a2 = read_bim('%s.bim' % (file_prefix))
+			bim_cols, ref_cols, code_table, site_status = orient_bim_alleles(bim_ids, bim_pos, bim_a1, bim_a2, refs.pos_to_alleles, ref_index, args.flip_strand)
+		report_allele_harmonization(site_status, args.flip_strand, args.drop_ambiguous, metrics)
+		if args.allele_report:
+			write_allele_report(args.allele_report, bim_ids, bim_pos, bim_a1, bim_a2, bim_cols, refs.pos_to_alleles, site_status)
+			print('Wrote the allele comparison of each snp at a reference position to %s' % (args.allele_report))
+		if args.drop_ambiguous:
+			keep = site_status != SITE_AMBIGUOUS
+			bim_cols, ref_cols, code_table = bim_cols[keep], ref_cols[keep], code_table[keep]
+		genotyped = np.zeros(len(ref_index), dtype=bool)
+		genotyped[ref_cols] = True
+
+		# stream samples in chunks, decoding genotype calls for each chunk into one matrix
+		if use_bed:
+			code_chunks = iter_bed_chunks(bed, '%s.fam' % (file_prefix), len(bim_pos), bim_cols, args.chunk_size)
+		else:
+			code_chunks = iter_raw_chunks(raw, bim_a1, bim_cols, args.chunk_size)
+		genotype_chunks = ((sample_ids, build_genotype_matrix(codes, ref_cols, code_table, len(ref_index))) for sample_ids, codes in code_chunks)
+	hg_snp_dict = get_called_hg_snps(refs.hg_snps, refs.hg_marker_cols, genotyped)
+	if metrics is not None:
+		# defining snps that cannot be scored are dropped without a message, so they are counted here
+		n_markers, n_unresolved, n_not_genotyped = count_unused_markers(refs.hg_marker_cols, genotyped)
+		metrics.count('reference_snps', len(ref_index))
+		metrics.count('reference_snps_genotyped', np.count_nonzero(genotyped))
+		metrics.count('defining_snps', n_markers)
+		metrics.count('defining_snps_unresolved', sum(n_unresolved.values()))
+		metrics.count('defining_snps_id_not_in_id_to_pos', n_unresolved.get(MARKER_NO_ID, 0))
+		metrics.count('defining_snps_position_not_in_pos_to_allele', n_unresolved.get(MARKER_NO_ALLELES, 0))
+		metrics.count('defining_snps_not_genotyped', n_not_genotyped)
+		metrics.count('haplogroups', len(hg_snp_dict))
+		metrics.count('haplogroups_without_genotyped_snps', sum(1 for hg in hg_snp_dict if not hg_snp_dict[hg]))
+
+	tree = refs.tree
+	trunc_haps = get_trunc_haps(args.truncate_haps, list(hg_snp_dict.keys()), tree)
 	# assign samples to hg
-	assign_subgroups(path, group_to_parent, n_individuals, haplogroup_score, hg_snp_dict, genotypes, issog_id_dict, sample_ids, args.min_hap_score , args.min_deep_score, args.out, args.ancestral_hg_depth, trunc_haps)    
+	# a checkpoint is only resumed by a run with the same input, reference and scoring settings
+	settings = {'infile': project_name, 'ref_hash': refs.ref_hash, 'min_hap_score': args.min_hap_score, 'min_deep_score': args.min_deep_score,
+	            'ancestral_hg_depth': args.ancestral_hg_depth, 'truncate_haps': args.truncate_haps, 'scores': args.scores, 'no_all': args.no_all,
+	            'all_top_k': args.all_top_k, 'all_min_score': args.all_min_score, 'flip_strand': args.flip_strand, 'drop_ambiguous': args.drop_ambiguous}
+	if args.sweep:
+		# score every combination of settings from one tally of the defining snps; no .out or .all files are written
+		grid = parse_sweep(args.sweep, vars(args))
+		sweep_subgroups(path, tree, genotype_chunks, refs.incidence, hg_snp_dict, args.out, trunc_haps, grid, args.sweep_truth, metrics)
+		return
+
+	if args.all_top_k is not None and args.all_top_k < 1:
+		print('--all_top_k must be at least 1. To leave out the .all file, use --no_all')
+		sys.exit()
+	scores_format = args.scores
+	if scores_format == 'parquet' and not score_matrix.has_pyarrow():
+		print('pyarrow is not installed, so the score matrix will be written as .npy arrays instead of parquet')
+		scores_format = 'npy'
+	if scores_format and args.result_cache:
+		print('The score matrix cannot be written with --result_cache, as cached samples are not scored again. Rerun without one of --scores or --result_cache')
+		sys.exit()
+
+	result_cache = None
+	if args.result_cache:
+		# cached results depend on the reference, the scoring settings, the truncated haplogroups, the genotyped positions and which .all lines are kept
+		context = json.dumps([refs.ref_hash, args.min_hap_score, args.min_deep_score, args.ancestral_hg_depth,
+		                      sorted(trunc_haps.items()), genotyped.tobytes().hex()] + (['no_all'] if args.no_all else [])
+		                     + ([args.all_top_k, args.all_min_score] if args.all_top_k is not None or args.all_min_score else []))
+		result_cache = ResultCache(args.result_cache, context)
+		print('Using result cache %s' % (args.result_cache))
+	try:
+		assign_subgroups(path, tree, genotype_chunks, refs.incidence, hg_snp_dict, args.min_hap_score , args.min_deep_score, args.out, args.ancestral_hg_depth, trunc_haps, args.processes, args.resume, settings, result_cache, metrics,
+		                 not args.no_all, scores_format, args.all_top_k, args.all_min_score)
+	finally:
+		if result_cache is not None:
+			result_cache.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='SNAPPY')
@@ -314,7 +758,7 @@ if __name__ == '__main__':
     parser.add_argument('--min_hap_score', help='minimum haplogroup score to be considered as assignment', nargs='?', const=1, type=float, default=0.75, required=False)
     parser.add_argument('--min_deep_score', help='minimum score to switch to deeper node for final assignment', nargs='?', const=1, type=float, default=0.8, required=False)
     parser.add_argument('--out', help='prefix for file output', nargs='?', const=1, type=str, default='chrY_hgs', required=False)
-    parser.add_argument('--ref_files_dir', help='directory where reference file are stored', nargs='?', const=1, type=str, default='ref_files', required=False)
+    parser.add_argument('--ref_files_dir', help='directory where reference file are stored, by default ref_files if it exists and otherwise the references packaged with SNAPPY', nargs='?', const=1, type=str, required=False)
     parser.add_argument('--id2pos', help='file listing SNP ids and corresponding positions', nargs='?', const=1, type=str, default='id_to_pos.txt', required=False)
     parser.add_argument('--pos2allele', help='file listing SNP positions and corresponding alleles', nargs='?', const=1, type=str, default='pos_to_allele.txt', required=False)
     parser.add_argument('--hg2snp', help='file listing markers and haplogroups', nargs='?', const=1, type=str, default='y_hg_and_snps.sort', required=False)
@@ -322,6 +766,24 @@ if __name__ == '__main__':
     parser.add_argument('--ancestral_hg_depth', help='number of ancestral haplogroups to check when considering whether a haplogroup receives a score', nargs='?', const=1, type=int, default=2, required=False)
     parser.add_argument('--truncate_haps', help='file with list of haplogroups past which SNAPPY will not make assignments', nargs='?', const=1, type=str, required=False)
     #parser.add_argument('--truncate_haps', help='file with list of haplogroups past which SNAPPY will not make assignments', action="store_const", const=1, required=False)
+    parser.add_argument('--ref_cache_dir', help='directory where compiled reference bundles are cached', type=str, required=False)
+    parser.add_argument('--no_ref_cache', help='parse the reference files on every run instead of caching a compiled bundle', action='store_true', required=False)
+    parser.add_argument('--chunk_size', help='number of samples read and scored at a time', type=int, default=10000, required=False)
+    parser.add_argument('--processes', '--threads', dest='processes', help='number of processes used to score samples', type=int, default=1, required=False)
+    parser.add_argument('--ref_fasta', help='indexed GRCh37 reference genome, used to expand gVCF reference blocks', type=str, required=False)
+    parser.add_argument('--resume', help='continue an interrupted run from its checkpoint, appending to its output', action='store_true', required=False)
+    parser.add_argument('--result_cache', help='SQLite file of cached per-sample results, reused for samples whose genotypes were scored before', type=str, required=False)
+    parser.add_argument('--sweep', help='score every combination of settings such as "min_hap_score=0.6,0.7;min_deep_score=0.8:0.95:0.05;ancestral_hg_depth=1,2" from one pass over the genotypes, writing .sweep.tsv and .sweep_summary.tsv instead of .out and .all', type=str, required=False)
+    parser.add_argument('--sweep_truth', help='tab-separated file of samples and reference haplogroups (eg. an earlier .out file) to measure sweep agreement against', type=str, required=False)
+    parser.add_argument('--metrics', help='json file to write wall time, CPU time and peak memory of each stage, samples per second and counts of unused reference snps to', type=str, required=False)
+    parser.add_argument('--profile', help='file to save cProfile statistics for the run to', type=str, required=False)
+    parser.add_argument('--scores', help='also write the full samples x haplogroups score matrix, with derived and called snp counts, as .npy arrays in {out}.scores or as {out}.scores.parquet', choices=SCORE_FORMATS, type=str, required=False)
+    parser.add_argument('--no_all', help='do not write the .all file', action='store_true', required=False)
+    parser.add_argument('--all_top_k', '--all-top-k', dest='all_top_k', help='list at most this many of the highest scoring haplogroups of each individual in the .all file', type=int, required=False)
+    parser.add_argument('--all_min_score', '--all-min-score', dest='all_min_score', help='list only haplogroups scoring at least this much in the .all file', type=float, default=0, required=False)
+    parser.add_argument('--flip_strand', help='read the alleles of plink snps that match the reference only on the complementary strand from that strand', action='store_true', required=False)
+    parser.add_argument('--drop_ambiguous', help='leave out plink snps at strand-ambiguous (A/T or C/G) reference positions', action='store_true', required=False)
+    parser.add_argument('--allele_report', help='tab-separated file to list each plink snp at a reference position in, with its alleles, the reference alleles and whether they match, are flipped, strand-swapped, ambiguous or incompatible', type=str, required=False)
     
     args = parser.parse_args()
     main(args)
@@ -1,6 +1,34 @@
-from .SNAPPY import snappy
-from .parse_ref_files import *
-from .parse_plink_files import *
-from .clean_isogg import clean_isogg
-from .isogg_qc import isogg_qc
-from .make_snappy_refs import make_snappy_refs
+"""
+tools are imported when they are first used, so that each command only pays for importing what it needs. The
+reference and plink parsing functions are also available from here, as they were when this package imported them all.
+Tools that share their name with their module (clean_isogg, isogg_qc, make_snappy_refs, compile_refs and serve) are
+not listed here, as snappy.bin.<name> is that module once it has been imported; import them from the snappy package
+or from their module instead
+"""
+
+import importlib
+
+_TOOLS = {
+    'snappy': '.SNAPPY',
+    'Classifier': '.classifier',
+    'Assignments': '.classifier',
+    'load_score_matrix': '.score_matrix',
+}
+
+# modules whose public names are also looked up here
+_PARSERS = ('.parse_ref_files', '.parse_plink_files')
+
+
+def __getattr__(name):
+    if name in _TOOLS:
+        value = getattr(importlib.import_module(_TOOLS[name], __name__), name)
+    else:
+        for parser in _PARSERS:
+            module = importlib.import_module(parser, __name__)
+            if not name.startswith('_') and hasattr(module, name):
+                value = getattr(module, name)
+                break
+        else:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    globals()[name] = value
+    return value
@@ -0,0 +1,223 @@
+"""
+bgzf.py
+
+Random access to BGZF-compressed files (bgzipped vcf and bcf) through tabix (.tbi) and coordinate-sorted (.csi)
+indexes. A BGZF file is a series of gzip members of at most 64Kb each; a virtual offset is the compressed offset of a
+block shifted left 16 bits plus the offset into the uncompressed block.
+"""
+
+import os
+import struct
+import sys
+import zlib
+
+# sizes of the BGZF block header and footer
+BGZF_HEADER_SIZE = 18
+BGZF_FOOTER_SIZE = 8
+
+TBI_MAGIC = b'TBI\x01'
+CSI_MAGIC = b'CSI\x01'
+
+# binning scheme of tabix indexes, which .csi indexes make configurable
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+
+
+class BgzfReader(object):
+    """reads a BGZF file one block at a time, with seek and tell in virtual offsets"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.handle = open(filename, 'rb')
+        self.block = b''
+        self.block_start = 0        # compressed offset of the current block
+        self.next_block = 0         # compressed offset of the block after it
+        self.within = 0             # offset into the uncompressed block
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def load_block(self, start):
+        """reads and inflates the block at a compressed offset. Returns False at the end of the file"""
+        self.handle.seek(start)
+        header = self.handle.read(BGZF_HEADER_SIZE)
+        if not header:
+            self.block = b''
+            self.block_start = self.next_block = start
+            self.within = 0
+            return False
+        if len(header) < BGZF_HEADER_SIZE or header[:4] != b'\x1f\x8b\x08\x04':
+            print('%s is not BGZF compressed (use bgzip rather than gzip)' % (self.filename))
+            sys.exit()
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = header[12:12 + 6] + self.handle.read(xlen - 6)
+        block_size = None
+        i = 0
+        while i < xlen:
+            subfield_id = extra[i:i + 2]
+            subfield_len = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if subfield_id == b'BC':
+                block_size = struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+            i += 4 + subfield_len
+        if block_size is None:
+            print('%s is not BGZF compressed (use bgzip rather than gzip)' % (self.filename))
+            sys.exit()
+        data = self.handle.read(block_size - 12 - xlen)
+        self.block = zlib.decompress(data[:-BGZF_FOOTER_SIZE], -15)
+        self.block_start = start
+        self.next_block = start + block_size
+        self.within = 0
+        return True
+
+    def seek(self, virtual_offset):
+        start = virtual_offset >> 16
+        if start != self.block_start or not self.block:
+            self.load_block(start)
+        self.within = virtual_offset & 0xffff
+
+    def tell(self):
+        if self.within == len(self.block):
+            return self.next_block << 16
+        return (self.block_start << 16) | self.within
+
+    def read(self, size):
+        """reads up to size uncompressed bytes, crossing block boundaries as needed"""
+        parts = []
+        while size > 0:
+            if self.within == len(self.block) and not self.load_block(self.next_block):
+                break
+            part = self.block[self.within:self.within + size]
+            self.within += len(part)
+            size -= len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+    def readline(self):
+        """reads up to and including the next newline"""
+        parts = []
+        while True:
+            if self.within == len(self.block) and not self.load_block(self.next_block):
+                break
+            end = self.block.find(b'\n', self.within)
+            if end >= 0:
+                parts.append(self.block[self.within:end + 1])
+                self.within = end + 1
+                break
+            parts.append(self.block[self.within:])
+            self.within = len(self.block)
+        return b''.join(parts)
+
+
+class TabixIndex(object):
+    """
+    the chunks of a .tbi or .csi index. Sequences are keyed by name for tabix-style indexes and by their position in
+    the index for bcf indexes, where names come from the bcf header
+    """
+
+    def __init__(self, names, bins, linear, min_shift, depth):
+        self.names = names          # sequence names, empty for bcf indexes
+        self.bins = bins            # per sequence, bin number -> list of (start, end) virtual offsets
+        self.linear = linear        # per sequence, tabix linear index (empty for .csi)
+        self.min_shift = min_shift
+        self.depth = depth
+
+    def get_chunks(self, ref_id, start, end):
+        """returns merged (start, end) virtual offsets covering records that may overlap the 0-based region start:end"""
+        if ref_id is None or ref_id >= len(self.bins):
+            return []
+        bins = self.bins[ref_id]
+        min_offset = 0
+        linear = self.linear[ref_id] if self.linear else []
+        if linear:
+            min_offset = linear[min(start >> TBI_MIN_SHIFT, len(linear) - 1)]
+        chunks = []
+        for bin_number in reg2bins(start, end, self.min_shift, self.depth):
+            for chunk_start, chunk_end in bins.get(bin_number, []):
+                if chunk_end > min_offset:
+                    chunks.append((chunk_start, chunk_end))
+        chunks.sort()
+        merged = []
+        for chunk_start, chunk_end in chunks:
+            if merged and chunk_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], chunk_end))
+            else:
+                merged.append((chunk_start, chunk_end))
+        return merged
+
+
+def reg2bins(start, end, min_shift, depth):
+    """returns the bins that may hold records overlapping the 0-based region start:end"""
+    bins = []
+    end -= 1
+    first_bin = 0
+    shift = min_shift + depth * 3
+    for level in range(depth + 1):
+        bins.extend(range(first_bin + (start >> shift), first_bin + (end >> shift) + 1))
+        first_bin += 1 << (level * 3)
+        shift -= 3
+    return bins
+
+
+def read_sequence_names(data, offset):
+    """reads the tabix header shared by .tbi indexes and tabix-style .csi indexes; returns the names and the next offset"""
+    l_nm = struct.unpack_from('<i', data, offset + 24)[0]
+    names = data[offset + 28:offset + 28 + l_nm].split(b'\x00')[:-1]
+    return [name.decode() for name in names], offset + 28 + l_nm
+
+
+def read_index(filename):
+    """reads a .tbi or .csi index"""
+    with BgzfReader(filename) as infp:
+        data = b''.join(iter(lambda: infp.read(1 << 20), b''))
+    magic = data[:4]
+    if magic == TBI_MAGIC:
+        n_ref = struct.unpack_from('<i', data, 4)[0]
+        names, offset = read_sequence_names(data, 8)
+        min_shift, depth = TBI_MIN_SHIFT, TBI_DEPTH
+    elif magic == CSI_MAGIC:
+        min_shift, depth, l_aux = struct.unpack_from('<iii', data, 4)
+        names = read_sequence_names(data, 16)[0] if l_aux >= 28 else []
+        offset = 16 + l_aux
+        n_ref = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+    else:
+        print('%s is not a tabix or csi index' % (filename))
+        sys.exit()
+
+    all_bins = []
+    all_linear = []
+    for ref_id in range(n_ref):
+        n_bin = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        bins = dict()
+        for i in range(n_bin):
+            bin_number = struct.unpack_from('<I', data, offset)[0]
+            offset += 4
+            if magic == CSI_MAGIC:
+                offset += 8     # loffset, not needed when the chunks are filtered by bin
+            n_chunk = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            chunks = struct.unpack_from('<%sQ' % (2 * n_chunk), data, offset)
+            offset += 16 * n_chunk
+            bins[bin_number] = list(zip(chunks[0::2], chunks[1::2]))
+        all_bins.append(bins)
+        if magic == TBI_MAGIC:
+            n_intv = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            all_linear.append(list(struct.unpack_from('<%sQ' % (n_intv), data, offset)))
+            offset += 8 * n_intv
+    return TabixIndex(names, all_bins, all_linear, min_shift, depth)
+
+
+def find_index(filename):
+    """returns the path of the .tbi or .csi index of a bgzipped file, or None if there is none"""
+    for suffix in ('.csi', '.tbi'):
+        if os.path.isfile(filename + suffix):
+            return filename + suffix
+    return None
@@ -0,0 +1,126 @@
+"""
+classifier.py
+
+In-process interface to SNAPPY's haplogroup assignment. A Classifier loads (or compiles and caches) the reference
+once, then assigns haplogroups to genotype matrices held in memory, with no file input or output.
+"""
+
+import numpy as np
+from snappy.bin.parse_plink_files import GT_MISSING, get_called_hg_snps, tally_defining_snps
+from snappy.bin.compile_refs import get_refs
+from snappy.bin.SNAPPY import score_hgs, pick_leaf, get_leaf_line, get_all_floors, get_all_subgroups, get_trunc_haps
+
+
+class Assignments(object):
+    """
+    haplogroup assignments for a batch of samples. haplogroups and leaf_haplogroups hold None for samples with no
+    scored haplogroup; hg_scores is a samples x haplogroups array in the order of hg_names, zero where unscored
+    """
+
+    def __init__(self, classifier, sample_ids, hg_scores, max_leaf, max_score, has_leaf):
+        self.classifier = classifier
+        self.sample_ids = list(sample_ids)
+        self.hg_scores = hg_scores
+        self.hg_names = classifier.hg_names
+        self.matched = hg_scores.any(axis=1)
+        self.scores = np.where(self.matched, max_score, 0.0)
+        self.has_leaf = has_leaf
+        self.max_leaf = max_leaf
+        names = classifier.tree.names
+        leaves = [names[leaf] if leaf >= 0 else 'A0-T' for leaf in max_leaf.tolist()]
+        self.leaf_haplogroups = [leaf if matched else None for leaf, matched in zip(leaves, self.matched.tolist())]
+        self.haplogroups = [classifier.trunc_haps[leaf] if leaf else None for leaf in self.leaf_haplogroups]
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    def __iter__(self):
+        """yields (sample id, assigned haplogroup, score) for every sample"""
+        return iter(zip(self.sample_ids, self.haplogroups, self.scores.tolist()))
+
+    def out_lines(self):
+        """returns the lines SNAPPY writes to the .out file for these samples"""
+        classifier = self.classifier
+        return [get_leaf_line(self.sample_ids[n], self.hg_scores[n], self.max_leaf[n], self.scores[n], self.has_leaf[n], classifier.tree,
+                              classifier.min_hap_score, classifier.hg_snps, classifier.trunc_haps)[0] for n in range(len(self))]
+
+    def all_lines(self, top_k=None, min_score=0):
+        """returns the lines SNAPPY writes to the .all file for these samples, listing at most top_k hgs scoring at least min_score"""
+        floors = get_all_floors(self.hg_scores, top_k, min_score)
+        return [get_all_subgroups(self.hg_scores[n], self.hg_names, self.sample_ids[n], floors[n], top_k) for n in range(len(self))]
+
+
+class Classifier(object):
+    """
+    assigns Y-chromosome haplogroups to genotype matrices in memory. The reference is loaded once, from the compiled
+    reference cache when possible, and reused for every call to classify.
+
+    Genotype matrices are samples x positions arrays of the codes GT_MISSING (-1), GT_ANCESTRAL (0), GT_DERIVED (1)
+    and GT_OTHER (2). Columns follow the positions attribute unless other positions are passed to classify.
+    genotyped lists the positions typed by the genotyping platform, and only limits which defining SNPs are listed
+    in .out lines; by default all reference positions are taken as typed.
+    """
+
+    def __init__(self, ref_files_dir=None, id2pos='id_to_pos.txt', pos2allele='pos_to_allele.txt', hg2snp='y_hg_and_snps.sort',
+                 tree_strct='tree_structure.txt', min_hap_score=0.75, min_deep_score=0.8, ancestral_hg_depth=2, truncate_haps=None,
+                 ref_cache_dir=None, genotyped=None):
+        self.refs = get_refs(ref_files_dir, id2pos, pos2allele, hg2snp, tree_strct, ref_cache_dir)
+        self.tree = self.refs.tree
+        self.incidence = self.refs.incidence
+        self.hg_names = self.tree.names[:self.tree.n_hgs]
+        self.positions = np.asarray(self.refs.snp_positions)
+        self.min_hap_score = min_hap_score
+        self.min_deep_score = min_deep_score
+        self.ancestral_hg_depth = ancestral_hg_depth
+
+        self.ref_index = dict((pos, j) for j, pos in enumerate(self.positions.tolist()))
+        is_genotyped = np.ones(len(self.positions), dtype=bool)
+        if genotyped is not None:
+            is_genotyped[:] = False
+            is_genotyped[self.get_columns(genotyped)[1]] = True
+        self.hg_snps = get_called_hg_snps(self.refs.hg_snps, self.refs.hg_marker_cols, is_genotyped)
+        self.trunc_haps = get_trunc_haps(truncate_haps, list(self.hg_snps.keys()), self.tree)
+
+    def get_columns(self, positions):
+        """returns the indexes of the positions found in the reference, and the reference columns they map to"""
+        found = [(i, self.ref_index[int(pos)]) for i, pos in enumerate(positions) if int(pos) in self.ref_index]
+        if not found:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        in_cols, ref_cols = zip(*found)
+        return np.array(in_cols, dtype=np.intp), np.array(ref_cols, dtype=np.intp)
+
+    def to_reference_matrix(self, genotypes, positions=None):
+        """returns a samples x reference-positions int8 matrix, moving the columns of genotypes given at other positions"""
+        genotypes = np.asarray(genotypes, dtype=np.int8)
+        if genotypes.ndim == 1:
+            genotypes = genotypes[np.newaxis, :]
+        if positions is None:
+            if genotypes.shape[1] != len(self.positions):
+                raise ValueError('genotype matrix has %s columns but the reference has %s positions' % (genotypes.shape[1], len(self.positions)))
+            return genotypes
+        if genotypes.shape[1] != len(positions):
+            raise ValueError('genotype matrix has %s columns but %s positions were given' % (genotypes.shape[1], len(positions)))
+        in_cols, ref_cols = self.get_columns(positions)
+        ref_genotypes = np.full((genotypes.shape[0], len(self.positions)), GT_MISSING, dtype=np.int8)
+        ref_genotypes[:, ref_cols] = genotypes[:, in_cols]
+        return ref_genotypes
+
+    def classify(self, genotypes, sample_ids=None, positions=None):
+        """
+        assigns haplogroups to every row of a genotype matrix. sample_ids default to row numbers; positions give the
+        position of each column when they are not the reference positions. Returns an Assignments object
+        """
+        genotypes = self.to_reference_matrix(genotypes, positions)
+        if sample_ids is None:
+            sample_ids = [str(n) for n in range(genotypes.shape[0])]
+        elif len(sample_ids) != genotypes.shape[0]:
+            raise ValueError('%s sample ids were given for %s genotype rows' % (len(sample_ids), genotypes.shape[0]))
+        hg_scores, hg_called = tally_defining_snps(genotypes, self.incidence)
+        all_scores = score_hgs(hg_scores, hg_called, self.tree, self.ancestral_hg_depth)
+        max_leaf, max_score, has_leaf = pick_leaf(all_scores, self.tree, self.min_hap_score, self.min_deep_score)
+        return Assignments(self, sample_ids, all_scores, max_leaf, max_score, has_leaf)
+
+    def classify_iter(self, chunks, positions=None):
+        """assigns haplogroups to a stream of (sample ids, genotype matrix) chunks, yielding Assignments for each"""
+        for sample_ids, genotypes in chunks:
+            yield self.classify(genotypes, sample_ids, positions)
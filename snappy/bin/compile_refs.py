@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+compile SNAPPY's reference files into a binary bundle
+
+The four reference files (id_to_pos.txt, pos_to_allele.txt, y_hg_and_snps.sort and tree_structure.txt) are parsed once,
+and the result is saved as a directory of .npy arrays plus a small json file with haplogroup and marker names. Bundles
+are memory-mapped when loaded. SNAPPY caches bundles automatically, keyed on a hash of the contents of the four files.
+
+A bundle of the default reference files is packaged with SNAPPY (snappy/ref_bundle), and is used when no reference
+directory is given and there is no ref_files directory in the working directory. After changing ref_files, rebuild it
+with: snappy-compile-refs --ref_files_dir ref_files --out snappy/ref_bundle
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+from scipy import sparse
+from snappy.bin.parse_ref_files import *
+from snappy.bin.hg_tree import HaplogroupTree
+
+# bump when the layout of a bundle changes, so older cached bundles are not reused
+REF_BUNDLE_VERSION = 2     # 2: defining snps at positions without alleles are marked apart from unknown ids
+
+REF_BUNDLE_NAMES = 'names.json'
+
+DEFAULT_REF_FILES_DIR = 'ref_files'
+DEFAULT_REF_FILE_NAMES = ('id_to_pos.txt', 'pos_to_allele.txt', 'y_hg_and_snps.sort', 'tree_structure.txt')
+
+PACKAGED_REF_BUNDLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ref_bundle')
+
+
+class CompiledRefs(object):
+    """
+    reference data in the form used for scoring: the haplogroup-informative positions with their derived and
+    ancestral alleles, the sparse haplogroup x snp incidence matrix, the matrix column of every defining snp, and the
+    compiled haplogroup tree
+    """
+
+    def __init__(self, hg_snps, snp_positions, derived_alleles, ancestral_alleles, incidence, hg_marker_cols, tree, ref_hash=None):
+        self.hg_snps = hg_snps
+        self.snp_positions = snp_positions
+        self.derived_alleles = derived_alleles
+        self.ancestral_alleles = ancestral_alleles
+        self.incidence = incidence
+        self.hg_marker_cols = hg_marker_cols
+        self.tree = tree
+        self.ref_hash = ref_hash
+
+    @property
+    def ref_index(self):
+        """maps a position, as a string, to its column of the genotype matrix"""
+        return dict((str(pos), j) for j, pos in enumerate(self.snp_positions.tolist()))
+
+    @property
+    def pos_to_alleles(self):
+        """maps a position, as a string, to a string of its derived and ancestral alleles"""
+        return dict((str(pos), der + anc) for pos, der, anc in zip(self.snp_positions.tolist(), self.derived_alleles, self.ancestral_alleles))
+
+    def get_unresolved_markers(self):
+        """lists the defining snps that cannot be scored, as (haplogroup, snp, reason) tuples"""
+        return get_unresolved_markers(self.hg_snps, self.hg_marker_cols)
+
+
+def get_ref_files(ref_files_dir, id2pos, pos2allele, hg2snp, tree_strct):
+    """returns the paths of the four reference files, in the order used for hashing"""
+    return [os.path.join(ref_files_dir, filename) for filename in (id2pos, pos2allele, hg2snp, tree_strct)]
+
+
+def hash_ref_files(ref_files):
+    """returns a hash of the contents of the reference files and the bundle version"""
+    digest = hashlib.sha256(('snappy-refs-%s' % (REF_BUNDLE_VERSION)).encode())
+    for filename in ref_files:
+        with open(filename, 'rb') as infp:
+            digest.update(hashlib.sha256(infp.read()).digest())
+    return digest.hexdigest()
+
+
+def build_compiled_refs(ref_files):
+    """parses the reference files and compiles them for scoring"""
+    id2pos, pos2allele, hg2snp, tree_strct = ref_files
+    der_allele_dict = build_derived_allele_dict(pos2allele)
+    hg_snp_dict = build_hg_snp_dict(hg2snp)
+    issog_id_dict = build_isogg_id_dict(id2pos)
+    group_to_parent = getHaploGroup2Parent(tree_strct)
+
+    snp_positions, incidence, hg_marker_cols = build_hg_snp_matrix(hg_snp_dict, issog_id_dict, der_allele_dict)
+    derived_alleles = [der_allele_dict[pos][0] for pos in snp_positions]
+    ancestral_alleles = [der_allele_dict[pos][1] for pos in snp_positions]
+    tree = HaplogroupTree(hg_snp_dict.keys(), group_to_parent)
+    snp_positions = np.array(snp_positions, dtype=np.int64)
+    snp_positions.flags.writeable = False
+    refs = CompiledRefs(hg_snp_dict, snp_positions, derived_alleles, ancestral_alleles, incidence, hg_marker_cols, tree, hash_ref_files(ref_files))
+
+    unresolved = refs.get_unresolved_markers()
+    if unresolved:
+        reasons = collections.Counter(reason for hg, snp, reason in unresolved)
+        print('%s defining SNPs cannot be located and are not scored (%s)' % (len(unresolved), ', '.join('%s: %s' % (reason, reasons[reason]) for reason in sorted(reasons))))
+    return refs
+
+
+def save_compiled_refs(refs, directory):
+    """writes compiled references to a bundle directory, replacing it atomically"""
+    parent_dir = os.path.dirname(os.path.abspath(directory))
+    if not os.path.isdir(parent_dir):
+        os.makedirs(parent_dir)
+    tmp_dir = tempfile.mkdtemp(prefix='.snappy_refs_', dir=parent_dir)
+    try:
+        write_compiled_refs(refs, tmp_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)      # another process finished the same bundle first
+
+
+def write_compiled_refs(refs, tmp_dir):
+    """writes the arrays and names of compiled references into an empty directory"""
+    hg_names = list(refs.hg_snps.keys())
+    tree_arrays = refs.tree.get_arrays()
+    marker_cols = [refs.hg_marker_cols[hg] for hg in hg_names]
+    arrays = {
+        'snp_positions': refs.snp_positions,
+        'incidence_data': refs.incidence.data,
+        'incidence_indices': refs.incidence.indices,
+        'incidence_indptr': refs.incidence.indptr,
+        'marker_cols': np.concatenate(marker_cols) if marker_cols else np.zeros(0, dtype=np.intp),
+        'marker_offsets': np.cumsum([0] + [len(cols) for cols in marker_cols]),
+    }
+    for key in ('parent', 'depth', 'ancestors', 'tin', 'tout'):
+        arrays['tree_' + key] = tree_arrays[key]
+    for key in arrays:
+        np.save(os.path.join(tmp_dir, key + '.npy'), arrays[key])
+
+    names = {
+        'version': REF_BUNDLE_VERSION,
+        'ref_hash': refs.ref_hash,
+        'hg_names': hg_names,
+        'hg_snps': [refs.hg_snps[hg] for hg in hg_names],
+        'derived_alleles': ''.join(refs.derived_alleles),
+        'ancestral_alleles': ''.join(refs.ancestral_alleles),
+        'group_to_parent': refs.tree.group_to_parent,
+        'extra_hg_names': tree_arrays['extra_names'],
+    }
+    with open(os.path.join(tmp_dir, REF_BUNDLE_NAMES), 'w') as outfp:
+        json.dump(names, outfp)
+
+
+def load_compiled_refs(directory):
+    """loads a reference bundle, memory-mapping its arrays. Returns None if the bundle is missing or out of date"""
+    names_file = os.path.join(directory, REF_BUNDLE_NAMES)
+    if not os.path.isfile(names_file):
+        return None
+    with open(names_file, 'r') as infp:
+        names = json.load(infp)
+    if names.get('version') != REF_BUNDLE_VERSION:
+        return None
+
+    def load(key):
+        return np.load(os.path.join(directory, key + '.npy'), mmap_mode='r')
+
+    hg_names = names['hg_names']
+    hg_snps = dict(zip(hg_names, names['hg_snps']))
+    incidence = sparse.csr_matrix((load('incidence_data'), load('incidence_indices'), load('incidence_indptr')),
+                                  shape=(len(hg_names), len(names['derived_alleles'])))
+    marker_cols = load('marker_cols')
+    marker_offsets = load('marker_offsets')
+    hg_marker_cols = dict((hg, marker_cols[marker_offsets[i]:marker_offsets[i + 1]]) for i, hg in enumerate(hg_names))
+    tree_arrays = dict((key, load('tree_' + key)) for key in ('parent', 'depth', 'ancestors', 'tin', 'tout'))
+    tree_arrays['extra_names'] = names['extra_hg_names']
+    tree = HaplogroupTree(hg_names, names['group_to_parent'], tree_arrays)
+    return CompiledRefs(hg_snps, load('snp_positions'), list(names['derived_alleles']), list(names['ancestral_alleles']),
+                        incidence, hg_marker_cols, tree, names['ref_hash'])
+
+
+def get_ref_cache_dir():
+    """
+    returns the directory where compiled reference bundles are cached: SNAPPY_CACHE_DIR, or snappy under
+    XDG_CACHE_HOME or ~/.cache. Returns None when there is no home directory to cache in
+    """
+    if os.environ.get('SNAPPY_CACHE_DIR'):
+        return os.environ['SNAPPY_CACHE_DIR']
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        home = os.path.expanduser('~')
+        if home == '~':
+            return None
+        cache_home = os.path.join(home, '.cache')
+    return os.path.join(cache_home, 'snappy')
+
+
+def is_writable_dir(directory):
+    """checks whether directory can be written to, or created in its nearest existing parent"""
+    directory = os.path.abspath(directory)
+    while not os.path.exists(directory):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return False
+        directory = parent
+    return os.path.isdir(directory) and os.access(directory, os.W_OK | os.X_OK)
+
+
+def get_compiled_refs(ref_files, cache_dir=None):
+    """
+    returns compiled references for the reference files, from the cache when a bundle for the same file contents
+    exists. Bundles are compiled and cached on first use; no caching is done when cache_dir is an empty string. A
+    cache that cannot be read or written is skipped, and the reference files are parsed instead
+    """
+    if cache_dir is None:
+        cache_dir = get_ref_cache_dir()
+    if not cache_dir:
+        return build_compiled_refs(ref_files)
+    bundle_dir = os.path.join(cache_dir, hash_ref_files(ref_files))
+    try:
+        refs = load_compiled_refs(bundle_dir)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        print('Warning: unable to read cached references in %s (%s), parsing the reference files instead' % (bundle_dir, e))
+        refs = None
+    if refs is None:
+        refs = build_compiled_refs(ref_files)
+        if not is_writable_dir(cache_dir):
+            print('The reference cache %s is not writable, so compiled references are not cached. Use --ref_cache_dir or SNAPPY_CACHE_DIR to cache them elsewhere' % (cache_dir))
+            return refs
+        try:
+            save_compiled_refs(refs, bundle_dir)
+            print('Cached compiled references in %s' % (bundle_dir))
+        except (IOError, OSError) as e:
+            print('Warning: unable to cache compiled references in %s (%s)' % (bundle_dir, e))
+    else:
+        print('Using compiled references from %s' % (bundle_dir))
+    return refs
+
+
+def get_refs(ref_files_dir, id2pos, pos2allele, hg2snp, tree_strct, cache_dir=None):
+    """
+    returns compiled references for the reference files in ref_files_dir. Without ref_files_dir, the files are read
+    from ref_files in the working directory when it exists; otherwise the default references packaged with SNAPPY are
+    loaded, without parsing or hashing any reference files
+    """
+    if ref_files_dir is None:
+        if not os.path.isdir(DEFAULT_REF_FILES_DIR) and (id2pos, pos2allele, hg2snp, tree_strct) == DEFAULT_REF_FILE_NAMES:
+            refs = load_compiled_refs(PACKAGED_REF_BUNDLE)
+            if refs is not None:
+                print('Using the default references packaged with SNAPPY')
+                return refs
+        ref_files_dir = DEFAULT_REF_FILES_DIR
+    return get_compiled_refs(get_ref_files(ref_files_dir, id2pos, pos2allele, hg2snp, tree_strct), cache_dir)
+
+
+def compile_refs(args):
+    ref_files = get_ref_files(args.ref_files_dir, args.id2pos, args.pos2allele, args.hg2snp, args.tree_strct)
+    cache_dir = get_ref_cache_dir()
+    if not args.out and not cache_dir:
+        print('There is no home directory to cache compiled references in. Use --out or SNAPPY_CACHE_DIR to say where to write them')
+        sys.exit()
+    refs = build_compiled_refs(ref_files)
+    out_dir = args.out if args.out else os.path.join(cache_dir, refs.ref_hash)
+    save_compiled_refs(refs, out_dir)
+    print('Compiled %s haplogroups and %s haplogroup-informative positions into %s' % (len(refs.hg_snps), len(refs.snp_positions), out_dir))
+    if args.unresolved:
+        with open(args.unresolved, 'w') as outfp:
+            outfp.write('haplogroup\tsnp\treason\n')
+            outfp.writelines('%s\t%s\t%s\n' % (hg, snp, reason) for hg, snp, reason in refs.get_unresolved_markers())
+        print('Listed defining SNPs that cannot be located in %s' % (args.unresolved))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='compile_refs', description="Compile SNAPPY's reference files into a binary bundle")
+
+    parser.add_argument('--ref_files_dir', help='directory where reference file are stored', nargs='?', const=1, type=str, default='ref_files', required=False)
+    parser.add_argument('--id2pos', help='file listing SNP ids and corresponding positions', nargs='?', const=1, type=str, default='id_to_pos.txt', required=False)
+    parser.add_argument('--pos2allele', help='file listing SNP positions and corresponding alleles', nargs='?', const=1, type=str, default='pos_to_allele.txt', required=False)
+    parser.add_argument('--hg2snp', help='file listing markers and haplogroups', nargs='?', const=1, type=str, default='y_hg_and_snps.sort', required=False)
+    parser.add_argument('--tree_strct', help='file listing haplogroup parent-child relationships for haplogroups that do not confrom to naming convetions', nargs='?', const=1, type=str, default='tree_structure.txt', required=False)
+    parser.add_argument('--out', help='directory for the compiled bundle, defaults to the reference cache', type=str, required=False)
+    parser.add_argument('--unresolved', help='tab-separated file to list the defining SNPs that cannot be located in, with the reason', type=str, required=False)
+
+    args = parser.parse_args()
+    compile_refs(args)
+    sys.exit()
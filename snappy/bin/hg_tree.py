@@ -0,0 +1,157 @@
+"""
+hg_tree.py
+
+Compiled representation of the Y-chromosome haplogroup tree. Haplogroups get integer ids, and parents, depths,
+ancestors and subtree intervals are stored in numpy arrays so that ancestry questions are answered with lookups
+instead of repeatedly walking haplogroup names.
+"""
+
+import sys
+import numpy as np
+
+
+def get_parent_hg(hg_to_parent, hg):
+    """returns the parental haplogroup"""
+    if hg in hg_to_parent:
+        return hg_to_parent[hg]
+    elif hg in ['A0-T', 'A00']:
+        return ''
+    else:
+        return hg[:-1]
+
+
+class HaplogroupTree(object):
+    """
+    tree of haplogroups built once from the reference haplogroups and the parent-child relationships of haplogroups
+    that do not follow naming conventions.
+
+    Nodes 0..n_hgs-1 are the reference haplogroups, in reference order, so node ids double as columns of the
+    haplogroup score arrays. Ancestors implied by the naming convention that are not reference haplogroups are added
+    after them, so ancestor depths match walking the names one parent at a time. Roots have parent -1.
+    """
+
+    def __init__(self, hg_names, group_to_parent, arrays=None):
+        self.group_to_parent = group_to_parent
+        self.names = list(hg_names)
+        self.n_hgs = len(self.names)
+        self.index = dict((hg, i) for i, hg in enumerate(self.names))
+        if arrays is not None:
+            self.set_arrays(arrays)
+            return
+
+        # add every ancestor named along the way, then link each node to its parent
+        parents = []
+        i = 0
+        while i < len(self.names):
+            parent_hg = get_parent_hg(group_to_parent, self.names[i])
+            if parent_hg and parent_hg not in self.index:
+                self.index[parent_hg] = len(self.names)
+                self.names.append(parent_hg)
+            parents.append(self.index[parent_hg] if parent_hg else -1)
+            i += 1
+        self.parent = np.array(parents, dtype=np.intp)
+        n_nodes = len(self.names)
+
+        # depth of every node, root at depth 0
+        self.depth = np.full(n_nodes, -1, dtype=np.intp)
+        for node in range(n_nodes):
+            path = []
+            while node >= 0 and self.depth[node] < 0:
+                if node in path:
+                    print('Haplogroup tree contains a cycle through %s. Please check the tree structure file' % (self.names[node]))
+                    sys.exit()
+                path.append(node)
+                node = self.parent[node]
+            depth = self.depth[node] if node >= 0 else -1
+            for path_node in reversed(path):
+                depth += 1
+                self.depth[path_node] = depth
+        max_depth = int(self.depth.max()) if n_nodes else 0
+
+        # nodes grouped by depth, from the roots down
+        self.levels = [np.flatnonzero(self.depth == d) for d in range(max_depth + 1)]
+
+        # ancestors[node, k] is the ancestor k+1 steps above node, or -1 past the root
+        self.ancestors = np.full((n_nodes, max(max_depth, 1)), -1, dtype=np.intp)
+        if n_nodes:
+            self.ancestors[:, 0] = self.parent
+        for k in range(1, max_depth):
+            above = self.ancestors[:, k - 1]
+            has_above = above >= 0
+            self.ancestors[has_above, k] = self.parent[above[has_above]]
+
+        # euler tour intervals: a is an ancestor of b when tin[a] < tin[b] and tout[b] <= tout[a]
+        children = [[] for node in range(n_nodes)]
+        for node in range(n_nodes):
+            if self.parent[node] >= 0:
+                children[self.parent[node]].append(node)
+        self.tin = np.zeros(n_nodes, dtype=np.intp)
+        self.tout = np.zeros(n_nodes, dtype=np.intp)
+        clock = 0
+        for root in np.flatnonzero(self.parent < 0):
+            stack = [(root, False)]
+            while stack:
+                node, visited = stack.pop()
+                if visited:
+                    self.tout[node] = clock
+                    continue
+                self.tin[node] = clock
+                clock += 1
+                stack.append((node, True))
+                for child in reversed(children[node]):
+                    stack.append((child, False))
+
+    def get_arrays(self):
+        """returns the compiled tree as a dictionary of arrays, with the names of added ancestors"""
+        return {'extra_names': self.names[self.n_hgs:], 'parent': self.parent, 'depth': self.depth,
+                'ancestors': self.ancestors, 'tin': self.tin, 'tout': self.tout}
+
+    def set_arrays(self, arrays):
+        """restores a tree compiled earlier from the output of get_arrays"""
+        for hg in arrays['extra_names']:
+            self.index[hg] = len(self.names)
+            self.names.append(hg)
+        self.parent = arrays['parent']
+        self.depth = arrays['depth']
+        self.ancestors = arrays['ancestors']
+        self.tin = arrays['tin']
+        self.tout = arrays['tout']
+        max_depth = int(self.depth.max()) if len(self.depth) else 0
+        self.levels = [np.flatnonzero(self.depth == d) for d in range(max_depth + 1)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, hg):
+        return hg in self.index
+
+    def get_parent(self, hg):
+        """returns the parental haplogroup, or an empty string for a root"""
+        if hg in self.index:
+            parent = self.parent[self.index[hg]]
+            return self.names[parent] if parent >= 0 else ''
+        return get_parent_hg(self.group_to_parent, hg)
+
+    def ancestor_ids(self, node):
+        """returns the ids of all ancestors of a node, nearest first"""
+        row = self.ancestors[node]
+        return row[:self.depth[node]]
+
+    def get_ancestry(self, hg):
+        """create list of all parent haplogroups"""
+        if hg in self.index:
+            return [self.names[a] for a in self.ancestor_ids(self.index[hg])]
+        # haplogroups outside the tree are walked by name until they join it
+        ancestors = []
+        hg = get_parent_hg(self.group_to_parent, hg)
+        while hg and hg not in self.index:
+            ancestors.append(hg)
+            hg = get_parent_hg(self.group_to_parent, hg)
+        if hg:
+            ancestors.append(hg)
+            ancestors.extend(self.names[a] for a in self.ancestor_ids(self.index[hg]))
+        return ancestors
+
+    def is_ancestor(self, ancestor, node):
+        """true when ancestor is a proper ancestor of node, both given as ids"""
+        return self.tin[ancestor] < self.tin[node] and self.tout[node] <= self.tout[ancestor]
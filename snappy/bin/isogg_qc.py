@@ -11,7 +11,6 @@ import os
 import sys
 import re
 from copy import deepcopy
-from snappy import *
 
 def dictIfEmpty(mydict, mykey):
 	if not mykey in mydict:
@@ -5,13 +5,18 @@ aims to have a user-specified count of snps for each haplotype
 aims to cover every node from the root down to a user-specified distance (in node count) from the root
 
 input is a .txt created from isogg_snp_compiler.py
+the ISOGG table is read once, and a set of reference files is made for each list of genotyped positions given
 """
 
 __author__ = 'jashortt'
 
 import argparse
+import os
 import sys
 
+# columns of the ISOGG table used to build references, besides the position column of the chosen build
+ISOGG_COLUMNS = ['Name', 'Subgroup_Name', 'Ancestral_Allele', 'Derived_Allele']
+
 #returns pointer to a dictionary if key already exists or an empty dictionary
 def dictIfEmpty(mydict, mykey):
 	if not mykey in mydict:
@@ -54,20 +59,32 @@ def getHapTree (infile):
 			group_to_parent[line[0]] = line[1]
 		return group_to_parent
 
-#Creates a dictionary from input lines of a file. Each value is keyed by values in a header
-def getLineInfo(line, header):
-	info = dict()
-	if len(header) != len(line):
-		print('Incompatible line:\n%s\n%s' % ('\t'.join(header), '\t'.join(line)) )
-		sys.exit()
-	for key,val in zip(header, line):
-		info[key] = val
-	return info
+#reads the ISOGG table once into a dictionary of columns, keeping only the given columns, plus the mutation type of each snp
+def getIsoggTable(infile, columns):
+	print ('Getting SNP info from %s' % (infile))
+	with open(infile, 'r') as infp:
+		header = infp.readline().strip().split()
+		col_index = dict((col, i) for i, col in enumerate(header))
+		missing = [col for col in columns if col not in col_index]
+		if missing:
+			print('Columns %s are missing from %s' % (', '.join(missing), infile))
+			sys.exit()
+		table = dict((col, []) for col in columns)
+		col_values = [(col_index[col], table[col]) for col in columns]
+		for line in infp:
+			line = line.strip().split('\t')
+			if len(header) != len(line):
+				print('Incompatible line:\n%s\n%s' % ('\t'.join(header), '\t'.join(line)) )
+				sys.exit()
+			for i, values in col_values:
+				values.append(line[i])
+	table['Mutation_Type'] = [classifyMutationType(anc, der) for anc, der in zip(table['Ancestral_Allele'], table['Derived_Allele'])]
+	return table
 
 #determines if a given mutation has strand-ambiguous alleles
 def mutationIsAmbiguous (a1, a2):
 	ambig_poly = {'A':'T', 'C':'G', 'G':'C', 'T':'A'}
-	if ambig_poly[a1] == a2:
+	if ambig_poly.get(a1) == a2:
 		return 1
 	else:
 		return 0
@@ -75,47 +92,39 @@ def mutationIsAmbiguous (a1, a2):
 #def determines if the alleles of a given mutation are transversions vs transitions. 
 def mutationIsTransversion (a1, a2):
 	good_poly = {'A':'G', 'C':'T', 'G':'A', 'T':'C'}			#might be more efficient to pass in than re-declare every time
-	if good_poly[a1] != a2:
+	if good_poly.get(a1) != a2:
 		return 1
 	else:
 		return 0
 	
 #determines mutation type for a snp		
-def classifyMutationType(hap_info, info):
-	snp_id = info['Name']
-	if mutationIsAmbiguous(info['Ancestral_Allele'], info['Derived_Allele']):
-		hap_info['ambig'] = dictIfEmpty(hap_info, 'ambig')
-		hap_info['ambig'][snp_id] = info
-	elif mutationIsTransversion(info['Ancestral_Allele'], info['Derived_Allele']):
-		hap_info['trv'] = dictIfEmpty(hap_info, 'trv')
-		hap_info['trv'][snp_id] = info
+def classifyMutationType(ancestral, derived):
+	if mutationIsAmbiguous(ancestral, derived):
+		return 'ambig'
+	elif mutationIsTransversion(ancestral, derived):
+		return 'trv'
 	else:						#mutation is a transition
-		hap_info['trs'] = dictIfEmpty(hap_info, 'trs')
-		hap_info['trs'][snp_id] = info									
+		return 'trs'
 
-#reads snp info from ISOGG file
-def getHapSnpInfo(infile, mypos, build):
-	print ('Getting SNP info from %s' % (infile))
+#groups the rows of the ISOGG table at genotyped positions by haplogroup and mutation type, keyed by snp name
+def getHapSnpInfo(table, mypos, build):
 	haps = {}
 	hap_order = []
-	with open(infile, 'r') as infp:
-		header = infp.readline().strip().split()
-		for line in infp:
-			info = getLineInfo(line.strip().split('\t'), header)
-			var_pos = info[build]
-			if var_pos in mypos:				#only keep if variant is in position list
-				hap = info['Subgroup_Name']				
-				if not hap in haps:
-					hap_info = dictIfEmpty(haps, hap)
-					hap_order.append(hap)
-				classifyMutationType(dictIfEmpty(haps, hap), info)
+	names = table['Name']
+	hg_names = table['Subgroup_Name']
+	mutation_types = table['Mutation_Type']
+	for row, var_pos in enumerate(table[build]):
+		if var_pos in mypos:				#only keep if variant is in position list
+			hap = hg_names[row]
+			if not hap in haps:
+				hap_order.append(hap)
+			hap_info = dictIfEmpty(haps, hap)
+			dictIfEmpty(hap_info, mutation_types[row])[names[row]] = row
 	return haps, hap_order
 	
-#makes a dictionary containing all ancestors for every haplogroup	
-def getHapAncestry(haps, hap_order, hap_tree):
-	for hap in hap_order:
-		hap_info = dictIfEmpty(haps, hap)	
-		hap_info['ancestors'] = get_ancestry(hap, hap_tree)
+#makes a dictionary containing all ancestors for every haplogroup in the ISOGG table
+def getHapAncestry(hg_names, hap_tree):
+	return dict((hap, get_ancestry(hap, hap_tree)) for hap in set(hg_names))
 
 #gets build from args
 def getHgBuild(build):
@@ -137,25 +146,23 @@ def getPos(infile):
 			mypos.add(var_pos[0])
 	return mypos
 		
-#select up to max_snp_count haplogroup informative snps for a haplogroup while prioritizing transition mutations over transversions, and transversions before strand-ambiguous snps	
+#select up to max_snp_count haplogroup informative snps (as ISOGG table rows) for a haplogroup while prioritizing transition mutations over transversions, and transversions before strand-ambiguous snps	
 def getSnps(hap_info, max_snp_count):
 	hap_snps = []
 	for snp_type in ['trs', 'trv', 'ambig']:
 		if snp_type in hap_info:
-			for snp in hap_info[snp_type].keys():
-				snp_info = hap_info[snp_type][snp]
-				hap_snps.append(snp_info)
+			hap_snps.extend(hap_info[snp_type].values())
 	if len(hap_snps) <= max_snp_count:
 		return hap_snps
 	else:
 		return hap_snps[0:max_snp_count-1]	
 
 #get snps for each haplogroup
-def makeSnps (haps, hap_order, max_snp_count, max_node_dist):
+def makeSnps (haps, hap_order, ancestry, max_snp_count, max_node_dist):
 	snappy_snps = {}
 	for hap in hap_order: #
 		hap_info = haps[hap]
-		if len(hap_info['ancestors']) <= int(max_node_dist): #
+		if len(ancestry[hap]) <= int(max_node_dist): #
 			snappy_snps[hap] = getSnps(hap_info, max_snp_count)
 			keep_snps = snappy_snps[hap]
 			#if len(keep_snps) < max_snp_count:
@@ -164,12 +171,29 @@ def makeSnps (haps, hap_order, max_snp_count, max_node_dist):
 				print ('Warning: No snps found for %s' % (hap))
 	return snappy_snps
 
+#returns the directory to write the references for a position file to: out_dir, or with several position files, a subdirectory of out_dir named after the position file
+def getOutDirs(out_dir, pos_files):
+	if len(pos_files) == 1:
+		return [out_dir]
+	out_dirs = [os.path.join(out_dir, os.path.splitext(os.path.basename(pos_file))[0]) for pos_file in pos_files]
+	if len(set(out_dirs)) < len(out_dirs):
+		print('Position files must have different names when several are given, as references for each are written to a directory named after it')
+		sys.exit()
+	return out_dirs
+
 #print snappy's reference files	
-def printSnappyRefs (snappy_snps, hap_order, outfile, mybuild):	#might be nice to print a summary of snps and nodes in tree
+def printSnappyRefs (snappy_snps, hap_order, table, mybuild, out_dir, outfile):	#might be nice to print a summary of snps and nodes in tree
 	total_snp_count = 0
 	hap_count = 0
+	if not os.path.isdir(out_dir):
+		os.makedirs(out_dir)
+	outfile = os.path.join(out_dir, outfile)
+	names = table['Name']
+	positions = table[mybuild]
+	ancestral_alleles = table['Ancestral_Allele']
+	derived_alleles = table['Derived_Allele']
 	print ('Now opening %s to print snp list' % (outfile))
-	with open(outfile, 'w') as outfp, open('id_to_pos.txt', 'w') as id2pos, open('pos_to_allele.txt', 'w') as pos2alleles, open('y_hg_and_snps.sort', 'w') as hgsort:
+	with open(outfile, 'w') as outfp, open(os.path.join(out_dir, 'id_to_pos.txt'), 'w') as id2pos, open(os.path.join(out_dir, 'pos_to_allele.txt'), 'w') as pos2alleles, open(os.path.join(out_dir, 'y_hg_and_snps.sort'), 'w') as hgsort:
 		id2pos.write('id\tpos\n')
 		pos2alleles.write('pos\tancestral_allele\tderived_allele\n')
 		hgsort.write('#haplogroup\tSNPs\n')
@@ -177,37 +201,43 @@ def printSnappyRefs (snappy_snps, hap_order, outfile, mybuild):	#might be nice t
 			if hap in snappy_snps:
 				hap_count += 1
 				hap_snps = snappy_snps[hap]
-				hgsort.write('%s\t%s\n' %( hap, ','.join([snp_info['Name'] for snp_info in hap_snps]) ))
-				for snp_info in hap_snps:
+				hgsort.write('%s\t%s\n' %( hap, ','.join([names[row] for row in hap_snps]) ))
+				for row in hap_snps:
 					total_snp_count += 1
-					snp_id = snp_info['Name']
-					pos = snp_info[mybuild]
-					ancestral = snp_info['Ancestral_Allele']
-					derived = snp_info['Derived_Allele']
+					snp_id = names[row]
+					pos = positions[row]
+					ancestral = ancestral_alleles[row]
+					derived = derived_alleles[row]
 					outfp.write( '%s\n' % ( '\t'.join([hap, snp_id, pos, ancestral, derived])) )
 					pos2alleles.write('%s\n' % ('\t'.join([pos, ancestral, derived])) )
 					id2pos.write('%s\t%s\n' %(snp_id, pos))
 	print ('Kept a total of total of %s snps for the %s haplogroups that met distance criterion.' % (str(total_snp_count), str(hap_count)))
 				
+#parses the ISOGG table once, then makes a set of reference files for each position file
 def make_snappy_refs (args):
-	mypos = getPos(args.pos_file)
+	out_dirs = getOutDirs(args.out_dir, args.pos_file)
 	mybuild = getHgBuild(args.build)
-	haps, hap_order = getHapSnpInfo(args.snp_file, mypos, mybuild)
+	table = getIsoggTable(args.snp_file, ISOGG_COLUMNS + [mybuild])
 	hap_tree = getHapTree(args.tree_file)
-	getHapAncestry(haps, hap_order, hap_tree)
-	keep_snps = makeSnps(haps, hap_order, args.snp_count, args.max_node_dist)
-	printSnappyRefs	(keep_snps, hap_order, '%s.txt' % (args.out), mybuild)
+	ancestry = getHapAncestry(table['Subgroup_Name'], hap_tree)
+	for pos_file, out_dir in zip(args.pos_file, out_dirs):
+		print ('Selecting SNPs at the positions in %s' % (pos_file))
+		mypos = getPos(pos_file)
+		haps, hap_order = getHapSnpInfo(table, mypos, mybuild)
+		keep_snps = makeSnps(haps, hap_order, ancestry, args.snp_count, args.max_node_dist)
+		printSnappyRefs	(keep_snps, hap_order, table, mybuild, out_dir, '%s.txt' % (args.out))
 		
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='make_snappy_refs', description="Make a set of reference files for use by SNAPPY. Makes some attempt at providing balanced allelic representation across Y-chromosome phylogeny but this is inherently limited by the SNPs present in the input data")
     
     parser.add_argument('--snp_file', help='a tab-separated file containing ISOGG snps', required=True)
-    parser.add_argument('--pos_file', help='list of physical positions of Y-chromosome genotypes, no header', required=True)
+    parser.add_argument('--pos_file', help='lists of physical positions of Y-chromosome genotypes, no header; a set of reference files is made for each', nargs='+', required=True)
     parser.add_argument('--tree_file', help='list of non-canonical relationships between haplogroups names, distributed with SNAPPY', default='ref_files/tree_structure.txt', required=False)
     parser.add_argument('--snp_count', help='a target for the number of haplogroup-informative SNPs to include for each haplogroup', type=int, default=5, required=False)
     parser.add_argument('--max_node_dist', help='the maximim distance from the root to build the tree', type=int, default=99, required=False)
     parser.add_argument('--build', help='genome build, hg37 or hg38', nargs='?', const='hg37', choices=['hg37', 'hg38'], type=str, default='hg37', required=False)
     parser.add_argument('--out', help='prefix for file output', nargs='?', const=1, type=str, default='SNAPPY_snp_list', required=False)
+    parser.add_argument('--out_dir', help='directory to write reference files to; with several position files, they are written to a subdirectory named after each', type=str, default='.', required=False)
 
     args = parser.parse_args()
     make_snappy_refs(args)
@@ -1,75 +1,280 @@
+import os
+import sys
 import numpy as np
 
 
-def get_individual_gt(pos_to_alleles, bim_id_to_pos, bim_snp_id, raw_gt):
-    """creates a dictionary for the sample which maps position to observed genotype"""
-    genotypes = dict()
-
-    for i in range(len(raw_gt)):
-        gt = raw_gt[i]
-        if bim_snp_id[i][:-2] in bim_id_to_pos:     # make sure bim id in id_to_pos dic (otherwise is a nocall)
-        	pos = bim_id_to_pos[bim_snp_id[i][:-2]]
-        	derived_allele, ancestral_allele = pos_to_alleles[pos].split(',')
-        	bim_allele = bim_snp_id[i][-1]
-        	
-        	# record genotype call in dictionary
-        	if bim_allele == derived_allele:
-        		if gt == '0':
-        			genotypes[pos] = ancestral_allele
-        		elif gt == '2':
-        			genotypes[pos] = derived_allele
-        		else:
-        			genotypes[pos] = 'N'
-        	elif bim_allele == ancestral_allele:
-        		if gt == '0':
-        			genotypes[pos] = derived_allele
-        		elif gt == '2':
-        			genotypes[pos] = ancestral_allele
-        		else:
-        			genotypes[pos] = 'N'
-        	elif bim_allele == '0':
-        		if gt == '0':
-        			genotypes[pos] = ancestral_allele
-        
+# codes stored in the genotype matrix, one int8 per sample and reference snp
+GT_MISSING = -1     # no call, heterozygous call, or snp not genotyped
+GT_ANCESTRAL = 0    # homozygous for the ancestral allele
+GT_DERIVED = 1      # homozygous for the derived allele
+GT_OTHER = 2        # called, but the allele is neither the ancestral nor the derived allele
+
+# first three bytes of a plink .bed file, the last byte marks snp-major mode
+BED_MAGIC = (0x6c, 0x1b, 0x01)
+
+# plink two-bit genotype codes
+BED_HOM_A1 = 0
+BED_MISSING = 1
+BED_HET = 2
+BED_HOM_A2 = 3
+
+# how the alleles of a .bim snp compare with the derived and ancestral alleles of its reference position
+SITE_MATCHING = 0       # A1 is the derived allele or A2 the ancestral allele
+SITE_FLIPPED = 1        # A1 is the ancestral allele or A2 the derived allele
+SITE_STRAND = 2         # the alleles match on the complementary strand
+SITE_AMBIGUOUS = 3      # the alleles match, but the reference alleles are A/T or C/G so the strand cannot be told
+SITE_INCOMPATIBLE = 4   # the alleles match neither strand
+SITE_STATUSES = ('matching', 'flipped', 'strand_swapped', 'ambiguous', 'incompatible')
+
+COMPLEMENT = str.maketrans('ACGTacgt', 'TGCAtgca')
+
+
+def read_fam_ids(filename):
+    """returns the individual ids listed in a plink .fam file, in file order"""
+    sample_ids = []
+    with open(filename, 'r') as fam:
+        for line in fam:
+            fields = line.split()
+            if fields:
+                sample_ids.append(fields[1])
+    return sample_ids
+
+
+def iter_fam_ids(filename, chunk_size):
+    """yields the individual ids listed in a plink .fam file in lists of up to chunk_size ids"""
+    sample_ids = []
+    with open(filename, 'r') as fam:
+        for line in fam:
+            fields = line.split()
+            if fields:
+                sample_ids.append(fields[1])
+                if len(sample_ids) == chunk_size:
+                    yield sample_ids
+                    sample_ids = []
+    if sample_ids:
+        yield sample_ids
+
+
+def count_fam_samples(filename):
+    """returns the number of individuals in a plink .fam file"""
+    n_samples = 0
+    with open(filename, 'r') as fam:
+        for line in fam:
+            if line.strip():
+                n_samples += 1
+    return n_samples
+
+
+def read_bim(filename):
+    """returns lists of snp ids, positions, A1 alleles and A2 alleles from a plink .bim file, in file order"""
+    bim_ids = []
+    bim_pos = []
+    bim_a1 = []
+    bim_a2 = []
+    with open(filename, 'r') as bim:
+        for line in bim:
+            fields = line.split()
+            if fields:
+                bim_ids.append(fields[1])
+                bim_pos.append(fields[3])
+                bim_a1.append(fields[4])
+                bim_a2.append(fields[5])
+    return bim_ids, bim_pos, bim_a1, bim_a2
+
+
+def open_bed(filename, n_samples, n_snps):
+    """memory-maps a snp-major plink .bed file as an array with one row of packed genotypes per snp"""
+    bytes_per_snp = (n_samples + 3) // 4
+    with open(filename, 'rb') as bed:
+        magic = tuple(bytearray(bed.read(3)))
+    if magic != BED_MAGIC:
+        print('%s is not a snp-major plink .bed file' % (filename))
+        sys.exit()
+    expected_size = len(BED_MAGIC) + bytes_per_snp * n_snps
+    if os.path.getsize(filename) != expected_size:
+        print('%s has %s bytes but %s samples and %s snps require %s' % (filename, os.path.getsize(filename), n_samples, n_snps, expected_size))
+        sys.exit()
+    return np.memmap(filename, dtype=np.uint8, mode='r', offset=len(BED_MAGIC), shape=(n_snps, bytes_per_snp))
+
+
+def decode_bed(packed, n_samples, start=0, stop=None, snps=None):
+    """
+    unpacks two-bit codes for samples start:stop into a snps x samples uint8 array (0=hom A1, 1=missing, 2=het,
+    3=hom A2). When snps is given, only those rows of the .bed file are read
+    """
+    if stop is None:
+        stop = n_samples
+    first_byte = start // 4
+    last_byte = (stop + 3) // 4
+    block = packed[:, first_byte:last_byte]
+    block = np.asarray(block[snps] if snps is not None else block)
+    codes = (block[:, :, np.newaxis] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+    codes = codes.reshape(block.shape[0], -1)
+    offset = first_byte * 4
+    return codes[:, start - offset:stop - offset]
+
+
+def iter_bed_chunks(bed_file, fam_file, n_snps, snps, chunk_size):
+    """yields the sample ids and decoded .bed codes of the given snps for consecutive chunks of up to chunk_size samples"""
+    n_samples = count_fam_samples(fam_file)
+    packed = open_bed(bed_file, n_samples, n_snps)
+    start = 0
+    for sample_ids in iter_fam_ids(fam_file, chunk_size):
+        stop = start + len(sample_ids)
+        yield sample_ids, decode_bed(packed, n_samples, start, stop, snps)
+        start = stop
+
+
+def iter_raw_chunks(filename, bim_a1, snps, chunk_size):
+    """
+    reads a .raw file written by plink --recodeAD and yields the sample ids and a snps x samples array of two-bit .bed
+    codes for consecutive chunks of up to chunk_size samples, so .raw and .bed input decode the same way. Columns are
+    expected in .bim order; only the given snps are decoded
+    """
+    with open(filename, 'r') as raw_data:
+        header = raw_data.readline().rstrip('\n').split(' ')[6:]
+        keep = [i for i in range(len(header)) if not header[i].endswith('_HET')]
+        if len(keep) != len(bim_a1):
+            print('%s has %s genotype columns but the .bim file lists %s snps' % (filename, len(keep), len(bim_a1)))
+            sys.exit()
+        # the counted allele is given by the column name suffix; translate allele counts to .bed codes
+        columns = []
+        count_to_code = []
+        for j in snps:
+            i = keep[j]
+            columns.append(i)
+            if header[i].rsplit('_', 1)[-1] == bim_a1[j]:
+                count_to_code.append({'0': BED_HOM_A2, '1': BED_HET, '2': BED_HOM_A1})
+            else:
+                count_to_code.append({'0': BED_HOM_A1, '1': BED_HET, '2': BED_HOM_A2})
+
+        sample_ids = []
+        rows = []
+        for line in raw_data:
+            line = line.rstrip('\n').split(' ')
+            sample_ids.append(line[1])
+            data = line[6:]
+            rows.append([count_to_code[k].get(data[i], BED_MISSING) for k, i in enumerate(columns)])
+            if len(sample_ids) == chunk_size:
+                yield sample_ids, np.array(rows, dtype=np.uint8).reshape(len(sample_ids), len(columns)).T
+                sample_ids = []
+                rows = []
+        if sample_ids:
+            yield sample_ids, np.array(rows, dtype=np.uint8).reshape(len(sample_ids), len(columns)).T
+
+
+def allele_to_gt(allele, derived_allele, ancestral_allele):
+    """returns the genotype matrix code for a homozygous call of allele"""
+    if allele == derived_allele:
+        return GT_DERIVED
+    elif allele == ancestral_allele:
+        return GT_ANCESTRAL
+    elif allele == '0':
+        return GT_MISSING
+    else:
+        return GT_OTHER
+
+
+def alleles_to_gt(alleles, derived_alleles, ancestral_alleles):
+    """returns the genotype matrix codes for homozygous calls of an array of alleles, as allele_to_gt does for one"""
+    gts = np.full(alleles.shape, GT_OTHER, dtype=np.int8)
+    gts[alleles == '0'] = GT_MISSING
+    gts[alleles == ancestral_alleles] = GT_ANCESTRAL
+    gts[alleles == derived_alleles] = GT_DERIVED
+    return gts
+
+
+def classify_bim_sites(a1, a2, derived_alleles, ancestral_alleles):
+    """compares arrays of .bim alleles with the reference alleles at their positions, returning a SITE_* code for each snp"""
+    def orientation(a1, a2):
+        # a '0' allele (not observed) is consistent with either reference allele
+        matching = ((a1 == derived_alleles) | (a1 == '0')) & ((a2 == ancestral_alleles) | (a2 == '0'))
+        flipped = ((a1 == ancestral_alleles) | (a1 == '0')) & ((a2 == derived_alleles) | (a2 == '0'))
+        return matching, flipped
+
+    matching, flipped = orientation(a1, a2)
+    strand_matching, strand_flipped = orientation(np.char.translate(a1, COMPLEMENT), np.char.translate(a2, COMPLEMENT))
+    ambiguous = np.char.translate(derived_alleles, COMPLEMENT) == ancestral_alleles
+    status = np.full(len(a1), SITE_INCOMPATIBLE, dtype=np.int8)
+    status[(strand_matching | strand_flipped) & ~ambiguous] = SITE_STRAND
+    status[flipped] = SITE_FLIPPED
+    status[matching] = SITE_MATCHING
+    status[(matching | flipped) & ambiguous] = SITE_AMBIGUOUS
+    return status
+
+
+def orient_bim_alleles(bim_ids, bim_pos, bim_a1, bim_a2, pos_to_derived_allele, ref_index, flip_strand=False):
+    """
+    works out once per .bim column how each two-bit genotype code translates to a genotype matrix code. Each snp at a
+    reference position is classified by how its alleles compare with the reference alleles (SITE_*), and with
+    flip_strand the alleles of strand-swapped snps are complemented. Returns the .bim columns at reference positions, the reference column each one fills, a columns x 4 int8 lookup
+    table, and the site status of each column
+    """
+    # snps are located through their .bim id, as with .raw column names; when an id is listed more than once the last entry is used
+    id_to_col = dict()
+    for i in range(len(bim_ids)):
+        if bim_a1[i] != '0' or bim_a2[i] != '0':
+            id_to_col[bim_ids[i]] = i
+    col_for_ref = dict()
+    for i in sorted(id_to_col.values()):
+        if bim_pos[i] in ref_index:
+            col_for_ref[ref_index[bim_pos[i]]] = i
+
+    ref_cols = np.array(sorted(col_for_ref), dtype=np.intp)
+    bim_cols = np.array([col_for_ref[j] for j in ref_cols], dtype=np.intp)
+    ref_alleles = [pos_to_derived_allele[bim_pos[i]] for i in bim_cols]
+    derived_alleles = np.array([alleles[0] for alleles in ref_alleles], dtype=str)
+    ancestral_alleles = np.array([alleles[1] for alleles in ref_alleles], dtype=str)
+    a1 = np.array(bim_a1, dtype=str)[bim_cols]
+    a2 = np.array(bim_a2, dtype=str)[bim_cols]
+    site_status = classify_bim_sites(a1, a2, derived_alleles, ancestral_alleles)
+
+    if flip_strand:
+        strand = site_status == SITE_STRAND
+        a1[strand] = np.char.translate(a1[strand], COMPLEMENT)
+        a2[strand] = np.char.translate(a2[strand], COMPLEMENT)
+
+    code_table = np.full((len(bim_cols), 4), GT_MISSING, dtype=np.int8)
+    code_table[:, BED_HOM_A1] = alleles_to_gt(a1, derived_alleles, ancestral_alleles)
+    code_table[:, BED_HOM_A2] = alleles_to_gt(a2, derived_alleles, ancestral_alleles)
+    return bim_cols, ref_cols, code_table, site_status
+
+
+def write_allele_report(filename, bim_ids, bim_pos, bim_a1, bim_a2, bim_cols, pos_to_derived_allele, site_status):
+    """writes the .bim snps at reference positions, their alleles, the reference alleles and their site status as a tab-separated file"""
+    with open(filename, 'w') as outfp:
+        outfp.write('id\tpos\ta1\ta2\tderived\tancestral\tstatus\n')
+        for i, status in zip(bim_cols.tolist(), site_status.tolist()):
+            derived_allele, ancestral_allele = pos_to_derived_allele[bim_pos[i]]
+            outfp.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (bim_ids[i], bim_pos[i], bim_a1[i], bim_a2[i], derived_allele, ancestral_allele, SITE_STATUSES[status]))
+
+
+def build_genotype_matrix(codes, ref_cols, code_table, n_ref):
+    """decodes .bed codes for the oriented .bim columns (columns x samples) into a samples x reference-snps int8 genotype matrix"""
+    n_samples = codes.shape[1]
+    genotypes = np.full((n_samples, n_ref), GT_MISSING, dtype=np.int8)
+    if len(ref_cols):
+        oriented = code_table[np.arange(len(ref_cols))[:, np.newaxis], codes]
+        genotypes[:, ref_cols] = oriented.T
     return genotypes
 
 
-def tally_defining_snps(n_samples, genotypes, hg_to_snp, id_to_pos, pos_to_derived_allele):
-    """for each haplogroup, count how many of the defining snps are derived and record efficiently in numpy array"""
-    hg_score = np.zeros((n_samples, len(hg_to_snp)))
-    hg_names = list(hg_to_snp.keys())
-
-    for n in range(n_samples):
-        pos_to_gt = genotypes[n]
-        for j in range(len(hg_names)):
-            defining_snps = hg_to_snp[hg_names[j]]
-            n_defining_snps = 0
-            for snp in defining_snps:
-                # check if snp has multiple ids, find one which will give position
-                if '/' in snp:
-                    same_snp = snp.split('/')
-                    for s in same_snp:
-                        if s in id_to_pos:
-                            snp = s
-                            break
-                # count snp if the allele is derived
-                if snp in id_to_pos:
-                    pos = id_to_pos[snp]
-                    if pos in pos_to_gt and pos in pos_to_derived_allele:
-                    #if pos in pos_to_gt:
-                        gt = pos_to_gt[pos]
-                        derived_allele = pos_to_derived_allele[pos][0]
-                        if gt == derived_allele:
-                            n_defining_snps += 1
-                    else:
-                        # position not in bim file, need if statement bc will try to delete multiple times
-                        if snp in hg_to_snp[hg_names[j]]:
-                            hg_to_snp[hg_names[j]].remove(snp)
-
-                else:
-                    # don't know position of defining snp
-                    hg_to_snp[hg_names[j]].remove(snp)
-
-            hg_score[n, j] = n_defining_snps
-
-    return hg_score, hg_to_snp
+def get_called_hg_snps(hg_to_snps, hg_to_marker_cols, genotyped):
+    """returns, for each haplogroup, the defining snps that are located at a genotyped position"""
+    called_hg_snps = dict()
+    for hg in hg_to_snps:
+        marker_cols = hg_to_marker_cols[hg]
+        called_hg_snps[hg] = [snp for snp, col in zip(hg_to_snps[hg], marker_cols) if col >= 0 and genotyped[col]]
+    return called_hg_snps
+
+
+def tally_defining_snps(genotypes, incidence):
+    """
+    for each haplogroup, count how many of the defining snps are derived and how many are called, for all samples at
+    once as products of the sparse haplogroup x snp incidence matrix with the derived and non-missing masks
+    """
+    is_derived = (genotypes == GT_DERIVED).astype(np.float32)
+    is_called = (genotypes != GT_MISSING).astype(np.float32)
+    hg_score = np.asarray(incidence.dot(is_derived.T).T, dtype=np.float64)
+    hg_called = np.asarray(incidence.dot(is_called.T).T, dtype=np.float64)
+    return hg_score, hg_called
@@ -1,4 +1,11 @@
 import re
+import numpy as np
+from scipy import sparse
+
+# matrix columns given to defining snps that cannot be scored, by the reason they cannot be located
+MARKER_NO_ID = -1           # none of the snp's '/'-separated ids is listed in id_to_pos
+MARKER_NO_ALLELES = -2      # the snp's position has no alleles listed in pos_to_allele
+UNRESOLVED_REASONS = {MARKER_NO_ID: 'id not in id_to_pos', MARKER_NO_ALLELES: 'position not in pos_to_allele'}
 
 
 def build_bim_id_dict(filename):
@@ -70,3 +77,58 @@ def getHaploGroup2Parent(filename):
 	return group_to_parent
 
     
+
+
+def resolve_snp(snp, id_to_pos):
+    """returns the first of the '/'-separated ids of a snp that has a known position, or None"""
+    for candidate in snp.split('/'):
+        if candidate in id_to_pos:
+            return candidate
+    return None
+
+
+def build_hg_snp_matrix(hg_to_snps, id_to_pos, pos_to_derived_allele):
+    """
+    compiles the reference into a sparse haplogroup x snp incidence matrix over every haplogroup-informative position
+    with known alleles. Every defining snp is resolved to a position once, here. Returns the positions (matrix
+    columns, sorted), the incidence matrix in CSR format, and a dictionary giving the matrix column of each
+    haplogroup's defining snps as read-only arrays, with MARKER_NO_ID or MARKER_NO_ALLELES where a snp cannot be located
+    """
+    hg_to_marker_cols = dict()
+    for hg in hg_to_snps:
+        marker_pos = []
+        for snp in hg_to_snps[hg]:
+            snp_id = resolve_snp(snp, id_to_pos)
+            if snp_id is None:
+                marker_pos.append(MARKER_NO_ID)
+            elif id_to_pos[snp_id] not in pos_to_derived_allele:
+                marker_pos.append(MARKER_NO_ALLELES)
+            else:
+                marker_pos.append(id_to_pos[snp_id])
+        hg_to_marker_cols[hg] = marker_pos
+
+    snp_positions = sorted(set(pos for marker_pos in hg_to_marker_cols.values() for pos in marker_pos if isinstance(pos, str)), key=int)
+    pos_to_col = dict((pos, j) for j, pos in enumerate(snp_positions))
+
+    rows = []
+    cols = []
+    for i, hg in enumerate(hg_to_marker_cols):
+        marker_cols = np.array([pos_to_col[pos] if isinstance(pos, str) else pos for pos in hg_to_marker_cols[hg]], dtype=np.intp)
+        marker_cols.flags.writeable = False
+        hg_to_marker_cols[hg] = marker_cols
+        located = marker_cols[marker_cols >= 0]
+        rows.extend([i] * len(located))
+        cols.extend(located)
+    # a snp listed twice for a haplogroup is counted twice, duplicate entries are summed
+    incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(hg_to_snps), len(snp_positions)))
+    return snp_positions, incidence, hg_to_marker_cols
+
+
+def get_unresolved_markers(hg_to_snps, hg_to_marker_cols):
+    """lists the defining snps that cannot be scored, as (haplogroup, snp, reason) tuples in reference order"""
+    unresolved = []
+    for hg in hg_to_snps:
+        for snp, col in zip(hg_to_snps[hg], hg_to_marker_cols[hg]):
+            if col < 0:
+                unresolved.append((hg, snp, UNRESOLVED_REASONS[int(col)]))
+    return unresolved
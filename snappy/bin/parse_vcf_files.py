@@ -0,0 +1,392 @@
+"""
+parse_vcf_files.py
+
+Reads chrY genotypes from vcf (.vcf, bgzipped .vcf.gz) and bcf files without converting them with plink. When a
+.tbi or .csi index is present, only the part of the file covering the haplogroup-informative chrY positions is
+decompressed; otherwise the file is streamed and records on other chromosomes are skipped.
+
+Reference blocks of gVCF files (records whose only alternate allele is <NON_REF> or <*>, spanning POS to INFO/END) are
+expanded over the reference positions they cover, using the reference genome base at each position.
+
+vcf and bcf records hold every sample of one site, while scoring takes every site of a chunk of samples. Records are
+decoded in one pass into a reference-snps x samples matrix that is kept in a memory-mapped temporary file rather than
+in memory, and chunks of samples are read back from it, so memory stays bounded by --chunk_size.
+"""
+
+import gzip
+import os
+import struct
+import sys
+import tempfile
+import numpy as np
+from snappy.bin.bgzf import BgzfReader, read_index, find_index
+from snappy.bin.parse_plink_files import GT_MISSING, allele_to_gt
+
+# names under which chrY is listed, in order of preference
+CHRY_NAMES = ('Y', 'chrY', '24', 'chr24')
+
+BCF_MAGIC = b'BCF\x02'
+
+# alternate alleles that stand for any allele other than the reference, used in gVCF reference blocks
+SYMBOLIC_ALLELES = ('<NON_REF>', '<*>')
+
+# bcf typed value codes and the numpy types they are stored as
+BCF_TYPES = {1: np.int8, 2: np.int16, 3: np.int32, 5: np.float32, 7: np.uint8}
+BCF_TYPE_SIZES = {0: 0, 1: 1, 2: 2, 3: 4, 5: 4, 7: 1}
+
+# bcf integer sentinels for a missing value and for the end of a shorter vector (haploid calls in diploid samples)
+BCF_INT_MISSING = {1: -128, 2: -32768, 3: -2147483648}
+BCF_INT_VECTOR_END = {1: -127, 2: -32767, 3: -2147483647}
+
+
+def call_to_allele(call):
+    """returns the allele index of a haploid or homozygous vcf GT string such as 1, 0/0 or 1|1, or -1 for no call or a heterozygous call"""
+    calls = call.replace('|', '/').split('/')
+    if calls[0] == '.' or any(c != calls[0] for c in calls):
+        return -1
+    try:
+        return int(calls[0])
+    except ValueError:
+        return -1
+
+
+def alleles_to_codes(alleles, allele_index, derived_allele, ancestral_allele):
+    """translates allele indexes of a record (-1 for no call) to genotype matrix codes. Symbolic alleles are missing"""
+    lookup = [GT_MISSING if allele.startswith('<') else allele_to_gt(allele, derived_allele, ancestral_allele) for allele in alleles]
+    lookup = np.array(lookup + [GT_MISSING], dtype=np.int8)
+    return lookup[np.where(allele_index < len(alleles), allele_index, -1)]
+
+
+def vcf_record_alleles(fields):
+    """returns the alleles of a vcf record, split into fields, and the allele index called by every sample"""
+    alleles = [fields[3]] + fields[4].split(',')
+    if fields[8] == 'GT':
+        calls = fields[9:]
+    elif fields[8].startswith('GT:'):
+        calls = [sample.split(':', 1)[0] for sample in fields[9:]]
+    else:
+        return alleles, np.full(len(fields) - 9, -1, dtype=np.intp)
+    # a record has only a handful of distinct calls, so each is translated once
+    unique_calls, inverse = np.unique(np.array(calls), return_inverse=True)
+    lookup = np.array([call_to_allele(call) for call in unique_calls], dtype=np.intp)
+    return alleles, lookup[inverse.reshape(-1)]
+
+
+def is_reference_block(alt_alleles):
+    """true when the only alternate alleles of a record are symbolic, as in gVCF reference blocks"""
+    return all(allele in SYMBOLIC_ALLELES for allele in alt_alleles)
+
+
+def get_info_end(info, pos):
+    """returns the END of a record from its INFO field, or its position when END is not given"""
+    for item in info.split(';'):
+        if item.startswith('END='):
+            return int(item[4:])
+    return pos
+
+
+def read_fasta_bases(filename, positions):
+    """
+    returns the chrY bases of a reference genome at the given positions, as a dictionary keyed on position strings.
+    The fasta must be uncompressed and indexed with samtools faidx
+    """
+    fai = filename + '.fai'
+    if not os.path.isfile(fai):
+        print('Unable to find the index %s for the reference genome. Please index it with samtools faidx' % (fai))
+        sys.exit()
+    contigs = dict()
+    with open(fai, 'r') as infp:
+        for line in infp:
+            fields = line.split('\t')
+            contigs[fields[0]] = (int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4]))
+    chrom = next((name for name in CHRY_NAMES if name in contigs), None)
+    if chrom is None:
+        print('%s has no chrY sequence (listed as %s)' % (filename, ', '.join(CHRY_NAMES)))
+        sys.exit()
+    length, offset, line_bases, line_width = contigs[chrom]
+    bases = dict()
+    with open(filename, 'rb') as infp:
+        for pos in sorted(positions):
+            if 0 < pos <= length:
+                infp.seek(offset + (pos - 1) // line_bases * line_width + (pos - 1) % line_bases)
+                bases[str(pos)] = infp.read(1).decode().upper()
+    return bases
+
+
+class RefSweep(object):
+    """reference positions in sorted order, for finding the positions covered by a record or reference block"""
+
+    def __init__(self, ref_index, pos_to_alleles, ref_bases):
+        self.positions = np.array(sorted(int(pos) for pos in ref_index), dtype=np.int64)
+        self.ref_index = ref_index
+        self.pos_to_alleles = pos_to_alleles
+        self.ref_bases = ref_bases
+        self.unknown_bases = set()      # positions in reference blocks where the reference base is unknown
+
+    def covered(self, start, end):
+        """returns the reference positions from start to end, inclusive"""
+        return self.positions[np.searchsorted(self.positions, start):np.searchsorted(self.positions, end, side='right')]
+
+    def overlaps(self, start, end):
+        return np.searchsorted(self.positions, start) != np.searchsorted(self.positions, end, side='right')
+
+    def record_sites(self, pos, end, alleles, allele_index):
+        """yields (reference column, sample codes) for every reference position covered by a record"""
+        if not is_reference_block(alleles[1:]):
+            pos = str(pos)
+            if pos in self.ref_index:
+                derived_allele, ancestral_allele = self.pos_to_alleles[pos]
+                yield self.ref_index[pos], alleles_to_codes(alleles, allele_index, derived_allele, ancestral_allele)
+            return
+        # a reference block: samples calling allele 0 carry the reference base at every position it covers
+        codes_by_base = dict()
+        for block_pos in self.covered(pos, end).tolist():
+            block_pos = str(block_pos)
+            base = alleles[0][0] if block_pos == str(pos) else self.ref_bases.get(block_pos)
+            if base is None or base == 'N':
+                self.unknown_bases.add(block_pos)
+                continue
+            derived_allele, ancestral_allele = self.pos_to_alleles[block_pos]
+            key = (base, derived_allele, ancestral_allele)
+            if key not in codes_by_base:
+                codes_by_base[key] = alleles_to_codes([base] + alleles[1:], allele_index, derived_allele, ancestral_allele)
+            yield self.ref_index[block_pos], codes_by_base[key]
+
+
+def open_vcf_text(filename):
+    """opens a plain or gzip compressed vcf for reading bytes"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def read_vcf_samples(infp):
+    """reads the header of a vcf and returns the sample names"""
+    for line in infp:
+        if line.startswith(b'#CHROM'):
+            return line.rstrip(b'\r\n').decode().split('\t')[9:]
+        if not line.startswith(b'##'):
+            break
+    print('%s has no #CHROM header line' % (getattr(infp, 'name', 'vcf file')))
+    sys.exit()
+
+
+def iter_vcf_lines(filename, positions):
+    """
+    yields the chrY records of a vcf as lines. With an index, only the chunks overlapping the range of positions are
+    read
+    """
+    index_file = find_index(filename)
+    if index_file is None:
+        with open_vcf_text(filename) as infp:
+            read_vcf_samples(infp)
+            for line in infp:
+                chrom = line[:line.find(b'\t')].decode()
+                if chrom in CHRY_NAMES:
+                    yield line
+        return
+
+    index = read_index(index_file)
+    chrom = next((name for name in CHRY_NAMES if name in index.names), None)
+    if chrom is None:
+        return
+    chunks = index.get_chunks(index.names.index(chrom), int(positions[0]) - 1, int(positions[-1]))
+    prefix = (chrom + '\t').encode()
+    with BgzfReader(filename) as infp:
+        for chunk_start, chunk_end in chunks:
+            infp.seek(chunk_start)
+            while infp.tell() < chunk_end:
+                line = infp.readline()
+                if not line:
+                    break
+                if line.startswith(prefix):
+                    yield line
+
+
+def read_vcf_sites(filename, sweep):
+    """yields the sample names, then (reference column, sample codes) for each reference position a record covers"""
+    with open_vcf_text(filename) as infp:
+        yield read_vcf_samples(infp)
+    for line in iter_vcf_lines(filename, sweep.positions):
+        # only the leading fields are split until the record is known to cover a reference position
+        fields = line.split(b'\t', 8)
+        pos = int(fields[1])
+        end = pos
+        if is_reference_block(fields[4].decode().split(',')):
+            end = get_info_end(fields[7].decode(), pos)
+        if not sweep.overlaps(pos, end):
+            continue
+        alleles, allele_index = vcf_record_alleles(line.rstrip(b'\r\n').decode().split('\t'))
+        for site in sweep.record_sites(pos, end, alleles, allele_index):
+            yield site
+
+
+def parse_bcf_header(text):
+    """returns the sample names, contig names by id and the bcf string dictionary from the text header of a bcf"""
+    contigs = dict()
+    strings = {0: 'PASS'}
+    string_ids = {'PASS': 0}
+    samples = []
+    for line in text.split('\n'):
+        if line.startswith('#CHROM'):
+            samples = line.rstrip('\r').split('\t')[9:]
+        elif line.startswith(('##contig=<', '##INFO=<', '##FILTER=<', '##FORMAT=<')):
+            attributes = dict(item.split('=', 1) for item in line[line.index('<') + 1:].rstrip('>').split(',') if '=' in item)
+            name = attributes.get('ID')
+            if line.startswith('##contig'):
+                contigs[int(attributes.get('IDX', len(contigs)))] = name
+            elif name not in string_ids:
+                idx = int(attributes.get('IDX', max(strings) + 1))
+                strings[idx] = name
+                string_ids[name] = idx
+    return samples, contigs, strings
+
+
+def read_typed_descriptor(data, offset):
+    """reads a bcf typed value descriptor, returning the value type, the number of values and the next offset"""
+    descriptor = data[offset]
+    value_type = descriptor & 0x0f
+    count = descriptor >> 4
+    offset += 1
+    if count == 15:
+        count_type = data[offset] & 0x0f
+        count = int(np.frombuffer(data, dtype=BCF_TYPES[count_type], count=1, offset=offset + 1)[0])
+        offset += 1 + BCF_TYPE_SIZES[count_type]
+    return value_type, count, offset
+
+
+def read_bcf_alleles(shared, n_allele):
+    """returns the alleles of a bcf record from its shared part"""
+    offset = 24
+    value_type, count, offset = read_typed_descriptor(shared, offset)     # id
+    offset += count * BCF_TYPE_SIZES[value_type]
+    alleles = []
+    for i in range(n_allele):
+        value_type, count, offset = read_typed_descriptor(shared, offset)
+        alleles.append(shared[offset:offset + count].rstrip(b'\x00').decode())
+        offset += count
+    return alleles
+
+
+def read_bcf_calls(indiv, n_allele, n_sample, n_fmt, gt_key):
+    """returns the allele index called by every sample of a bcf record, -1 for no call or a heterozygous call"""
+    allele_index = np.full(n_sample, -1, dtype=np.intp)
+    offset = 0
+    for i in range(n_fmt):
+        key_type, count, offset = read_typed_descriptor(indiv, offset)
+        key = int(np.frombuffer(indiv, dtype=BCF_TYPES[key_type], count=1, offset=offset)[0])
+        offset += BCF_TYPE_SIZES[key_type]
+        value_type, count, offset = read_typed_descriptor(indiv, offset)
+        size = BCF_TYPE_SIZES[value_type] * count * n_sample
+        if key != gt_key:
+            offset += size
+            continue
+        if value_type not in BCF_INT_MISSING or count == 0:
+            break
+        values = np.frombuffer(indiv, dtype=BCF_TYPES[value_type], count=count * n_sample, offset=offset).reshape(n_sample, count).astype(np.int32)
+        ended = values == BCF_INT_VECTOR_END[value_type]
+        called = (values >> 1) - 1      # -1 for a missing allele
+        first = called[:, 0]
+        homozygous = np.all((called == first[:, np.newaxis]) | ended, axis=1) & (first >= 0) & (first < n_allele) & ~ended[:, 0]
+        allele_index[homozygous] = first[homozygous]
+        break
+    return allele_index
+
+
+def read_bcf_record(infp):
+    """reads the next bcf record, returning its shared and per-sample parts, or None at the end of the file"""
+    lengths = infp.read(8)
+    if len(lengths) < 8:
+        return None
+    l_shared, l_indiv = struct.unpack('<II', lengths)
+    return infp.read(l_shared), infp.read(l_indiv)
+
+
+def read_bcf_sites(filename, sweep):
+    """yields the sample names, then (reference column, sample codes) for each reference position a record covers"""
+    with BgzfReader(filename) as infp:
+        magic = infp.read(5)
+        if magic[:4] != BCF_MAGIC:
+            print('%s is not a bcf file' % (filename))
+            sys.exit()
+        l_text = struct.unpack('<I', infp.read(4))[0]
+        samples, contigs, strings = parse_bcf_header(infp.read(l_text).rstrip(b'\x00').decode())
+        yield samples
+        gt_key = next((idx for idx in strings if strings[idx] == 'GT'), None)
+        chrom_id = next((idx for name in CHRY_NAMES for idx in contigs if contigs[idx] == name), None)
+        if gt_key is None or chrom_id is None:
+            return
+
+        index_file = find_index(filename)
+        if index_file is not None:
+            chunks = read_index(index_file).get_chunks(chrom_id, int(sweep.positions[0]) - 1, int(sweep.positions[-1]))
+        else:
+            chunks = [(infp.tell(), None)]
+        for chunk_start, chunk_end in chunks:
+            infp.seek(chunk_start)
+            while chunk_end is None or infp.tell() < chunk_end:
+                record = read_bcf_record(infp)
+                if record is None:
+                    break
+                shared, indiv = record
+                chrom, pos, rlen = struct.unpack_from('<iii', shared, 0)
+                pos += 1
+                if chrom != chrom_id or not sweep.overlaps(pos, pos + max(rlen, 1) - 1):
+                    continue
+                n_allele_info, n_fmt_sample = struct.unpack_from('<II', shared, 16)
+                alleles = read_bcf_alleles(shared, n_allele_info >> 16)
+                end = pos + rlen - 1 if is_reference_block(alleles[1:]) else pos
+                allele_index = read_bcf_calls(indiv, len(alleles), n_fmt_sample & 0xffffff, n_fmt_sample >> 24, gt_key)
+                for site in sweep.record_sites(pos, end, alleles, allele_index):
+                    yield site
+
+
+def open_genotype_spill(n_ref, n_samples):
+    """
+    returns a reference-snps x samples int8 genotype matrix, set to missing, kept in an unnamed temporary file that is
+    removed once the matrix is no longer used
+    """
+    if not n_ref or not n_samples:
+        return np.full((n_ref, n_samples), GT_MISSING, dtype=np.int8)
+    with tempfile.TemporaryFile(prefix='snappy_vcf_') as spill:
+        genotypes = np.memmap(spill, dtype=np.int8, mode='w+', shape=(n_ref, n_samples))
+    genotypes[:] = GT_MISSING
+    return genotypes
+
+
+def read_vcf_genotypes(filename, pos_to_alleles, ref_index, ref_fasta=None):
+    """
+    reads the chrY genotypes of a vcf, gVCF or bcf at the reference positions. Returns the sample names, a
+    reference-snps x samples int8 genotype matrix, memory-mapped from a temporary file, and a mask of the reference
+    positions present in the file. When a position is covered by more than one record the last record is used.
+    Reference blocks are expanded with bases from ref_fasta, when given
+    """
+    ref_bases = read_fasta_bases(ref_fasta, [int(pos) for pos in ref_index]) if ref_fasta else dict()
+    sweep = RefSweep(ref_index, pos_to_alleles, ref_bases)
+    if filename.endswith('.bcf'):
+        sites = read_bcf_sites(filename, sweep)
+    else:
+        sites = read_vcf_sites(filename, sweep)
+    sample_ids = next(sites)
+    genotypes = open_genotype_spill(len(ref_index), len(sample_ids))
+    genotyped = np.zeros(len(ref_index), dtype=bool)
+    for col, codes in sites:
+        if len(codes) != len(sample_ids):
+            print('%s has a record with %s samples but the header lists %s' % (filename, len(codes), len(sample_ids)))
+            sys.exit()
+        genotypes[col] = codes
+        genotyped[col] = True
+    if sweep.unknown_bases and ref_fasta:
+        print('Warning: %s haplogroup-informative positions inside gVCF reference blocks were skipped because %s has no base for them' % (len(sweep.unknown_bases), ref_fasta))
+    elif sweep.unknown_bases:
+        print('Warning: %s haplogroup-informative positions inside gVCF reference blocks were skipped because their reference base is unknown. Use --ref_fasta to give the reference genome' % (len(sweep.unknown_bases)))
+    return sample_ids, genotypes, genotyped
+
+
+def iter_vcf_chunks(sample_ids, genotypes, chunk_size):
+    """
+    yields the sample ids and samples x reference-snps genotype matrix for consecutive chunks of up to chunk_size
+    samples; only the chunk being yielded is read into memory
+    """
+    for start in range(0, len(sample_ids), chunk_size):
+        yield sample_ids[start:start + chunk_size], np.ascontiguousarray(genotypes[:, start:start + chunk_size].T)
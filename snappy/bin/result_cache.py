@@ -0,0 +1,53 @@
+"""
+result_cache.py
+
+On-disk cache of per-sample results, kept in a SQLite file. Results are keyed on a hash of a sample's genotypes at
+the reference positions together with a hash of everything else that affects its .out and .all lines (the compiled
+reference, the scoring settings and the set of genotyped positions), so they can be reused across runs and cohorts.
+"""
+
+import hashlib
+import sqlite3
+
+# largest number of keys looked up in one query, below SQLite's limit on bound parameters
+LOOKUP_BATCH = 500
+
+
+class ResultCache(object):
+    """
+    cached .out and .all lines, without the sample id, and a message code for each genotype row. context is a string
+    identifying the reference and settings the results were made with
+    """
+
+    def __init__(self, filename, context):
+        self.filename = filename
+        self.context = hashlib.sha256(context.encode()).digest()
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, out_line TEXT, all_line TEXT, message INTEGER)')
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_keys(self, genotypes):
+        """returns the cache key of every row of a samples x reference-snps genotype matrix"""
+        return [hashlib.sha256(self.context + row.tobytes()).hexdigest() for row in genotypes]
+
+    def get(self, keys):
+        """returns a dictionary of the cached (out_line, all_line, message) for the keys found in the cache"""
+        found = dict()
+        unique_keys = list(set(keys))
+        for start in range(0, len(unique_keys), LOOKUP_BATCH):
+            batch = unique_keys[start:start + LOOKUP_BATCH]
+            query = 'SELECT key, out_line, all_line, message FROM results WHERE key IN (%s)' % (','.join('?' * len(batch)))
+            for key, out_line, all_line, message in self.db.execute(query, batch):
+                found[key] = (out_line, all_line, message)
+        return found
+
+    def put(self, rows):
+        """stores (key, out_line, all_line, message) rows"""
+        self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', rows)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,155 @@
+"""
+run_metrics.py
+
+Records wall time, CPU time and peak memory for each stage of a SNAPPY run, along with counts such as the number of
+samples scored and the reference snps that could not be used, and a histogram of scoring time per sample. Metrics are
+written as a json file with --metrics, and --profile saves cProfile statistics for the whole run.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError:     # not available on Windows, where peak memory is not reported
+    resource = None
+
+# upper edges, in seconds, of the bins of the per-sample scoring time histogram
+SAMPLE_TIME_BINS = [10 ** (k / 2.0) for k in range(-14, 3)]
+
+# number of functions listed when a profile is printed
+PROFILE_TOP = 25
+
+
+def get_peak_rss():
+    """returns the peak resident set size of this process, and of its finished child processes, in megabytes"""
+    if resource is None:
+        return None, None
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0     # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def get_current_rss():
+    """returns the current resident set size of this process in megabytes, where /proc is available"""
+    try:
+        with open('/proc/self/statm', 'r') as infp:
+            return int(infp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RunMetrics(object):
+    """
+    wall time, CPU time and memory of each stage of a run, in the order stages were first entered. A stage can be
+    entered many times, once per chunk of samples, and its times are summed. For memory, peak_rss_increase_mb sums how
+    far the process peak resident set size rose during each call of the stage, so a stage that does not allocate more
+    than earlier stages reports 0; rss_mb is the resident set size when the stage last exited
+    """
+
+    def __init__(self):
+        self.start_wall = time.time()
+        self.start_cpu = time.process_time()
+        self.stages = dict()
+        self.counts = dict()
+        self.n_samples = 0
+        self.sample_time_counts = np.zeros(len(SAMPLE_TIME_BINS) + 1, dtype=np.int64)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """times the enclosed block as part of stage name"""
+        start_wall = time.time()
+        start_cpu = time.process_time()
+        start_peak_rss = get_peak_rss()[0]
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_increase_mb': None})
+            stage['calls'] += 1
+            stage['wall_seconds'] += time.time() - start_wall
+            stage['cpu_seconds'] += time.process_time() - start_cpu
+            if start_peak_rss is not None:
+                stage['peak_rss_increase_mb'] = (stage['peak_rss_increase_mb'] or 0.0) + get_peak_rss()[0] - start_peak_rss
+            stage['rss_mb'] = get_current_rss()
+
+    def iter_stage(self, items, name):
+        """yields from an iterator, timing the work done to produce each item as part of stage name"""
+        items = iter(items)
+        while True:
+            with self.stage(name):
+                item = next(items, None)
+            if item is None:
+                return
+            yield item
+
+    def add_samples(self, n_samples, seconds):
+        """records that n_samples were scored together in seconds, adding their average time to the histogram"""
+        if not n_samples:
+            return
+        self.n_samples += n_samples
+        self.sample_time_counts[np.searchsorted(SAMPLE_TIME_BINS, seconds / n_samples)] += n_samples
+
+    def count(self, name, value):
+        self.counts[name] = int(value)
+
+    def get_summary(self):
+        wall_seconds = time.time() - self.start_wall
+        peak_rss, children_peak_rss = get_peak_rss()
+        histogram = [{'max_seconds': edge, 'samples': int(n)} for edge, n in zip(SAMPLE_TIME_BINS + [None], self.sample_time_counts)]
+        return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'host': platform.node(), 'python': platform.python_version(),
+                'wall_seconds': wall_seconds, 'cpu_seconds': time.process_time() - self.start_cpu, 'peak_rss_mb': peak_rss,
+                'children_peak_rss_mb': children_peak_rss, 'n_samples': self.n_samples,
+                'samples_per_second': self.n_samples / wall_seconds if wall_seconds > 0 else None,
+                'stages': self.stages, 'counts': self.counts, 'sample_seconds_histogram': histogram}
+
+    def write(self, filename):
+        with open(filename, 'w') as outfp:
+            json.dump(self.get_summary(), outfp, indent=1)
+        print('Wrote run metrics to %s' % (filename))
+
+
+def timed(metrics, name):
+    """times a block as stage name when metrics are being recorded"""
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name)
+
+
+def count_unused_markers(hg_marker_cols, genotyped):
+    """
+    counts the defining snps of the reference that are not scored: those without a position in the reference, by the
+    marker column code giving the reason, and those at a position that is not genotyped in the input
+    """
+    n_markers = 0
+    n_unresolved = dict()
+    n_not_genotyped = 0
+    for marker_cols in hg_marker_cols.values():
+        marker_cols = np.asarray(marker_cols)
+        resolved = marker_cols[marker_cols >= 0]
+        n_markers += len(marker_cols)
+        for code in marker_cols[marker_cols < 0].tolist():
+            n_unresolved[code] = n_unresolved.get(code, 0) + 1
+        n_not_genotyped += np.count_nonzero(~genotyped[resolved])
+    return n_markers, n_unresolved, n_not_genotyped
+
+
+@contextlib.contextmanager
+def profiled(filename):
+    """runs the enclosed block under cProfile, saving the statistics to filename and printing the slowest functions"""
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+        print('\nWrote profile to %s; the functions with the most cumulative time were:' % (filename))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP)
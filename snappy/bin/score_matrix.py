@@ -0,0 +1,172 @@
+"""
+score_matrix.py
+
+Writes the full samples x haplogroups score matrix of a run, with the number of derived and called defining snps of
+every haplogroup, as columnar output alongside (or instead of) the .all file. The default format is a directory of
+.npy arrays plus the haplogroup names in json, which readers can memory-map; with pyarrow installed, a parquet file
+can be written instead. Both are written a chunk of samples at a time.
+"""
+
+import importlib.util
+import json
+import os
+import struct
+import numpy as np
+
+SCORE_FORMATS = ('npy', 'parquet')
+
+SCORE_MATRIX_NAMES = 'haplogroups.json'
+SCORE_MATRIX_SAMPLES = 'samples.txt'
+
+# arrays of a score matrix and the types they are stored as
+SCORE_ARRAYS = (('scores', np.float32), ('derived', np.int32), ('called', np.int32))
+
+# .npy headers are written this long, so the header can be rewritten in place as rows are added
+NPY_HEADER_SIZE = 128
+
+
+class GrowingNpy(object):
+    """
+    a two-dimensional .npy file that rows are appended to. The header is rewritten with the number of rows after
+    every append, so the file can be loaded (and memory-mapped) at any point between appends
+    """
+
+    def __init__(self, filename, dtype, n_cols, n_rows=None):
+        self.dtype = np.dtype(dtype)
+        self.n_cols = n_cols
+        self.row_bytes = self.dtype.itemsize * n_cols
+        if n_rows is None:
+            self.outfp = open(filename, 'w+b')
+            self.n_rows = 0
+        else:
+            # keep the first n_rows, dropping rows written after them
+            self.outfp = open(filename, 'r+b')
+            self.outfp.truncate(NPY_HEADER_SIZE + n_rows * self.row_bytes)
+            self.n_rows = n_rows
+        self.write_header()
+
+    def write_header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d, %d), }" % (np.lib.format.dtype_to_descr(self.dtype), self.n_rows, self.n_cols)
+        header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+        self.outfp.seek(0)
+        self.outfp.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+        self.outfp.seek(0, os.SEEK_END)
+
+    def append(self, rows):
+        self.outfp.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self.n_rows += len(rows)
+        self.write_header()
+
+    def flush(self):
+        self.outfp.flush()
+        os.fsync(self.outfp.fileno())
+
+    def close(self):
+        self.outfp.close()
+
+
+class NpyScoreWriter(object):
+    """writes a score matrix as a directory of .npy arrays, the sample ids and the haplogroup names"""
+
+    def __init__(self, directory, hg_names, n_rows=None):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, SCORE_MATRIX_NAMES), 'w') as outfp:
+            json.dump({'hg_names': list(hg_names)}, outfp)
+        self.arrays = [GrowingNpy(os.path.join(directory, name + '.npy'), dtype, len(hg_names), n_rows) for name, dtype in SCORE_ARRAYS]
+        samples_file = os.path.join(directory, SCORE_MATRIX_SAMPLES)
+        if n_rows is None:
+            self.samples = open(samples_file, 'w')
+        else:
+            with open(samples_file, 'r+b') as infp:
+                for n in range(n_rows):
+                    infp.readline()
+                infp.truncate(infp.tell())
+            self.samples = open(samples_file, 'a')
+
+    def append(self, sample_id, scores, derived, called):
+        for array, values in zip(self.arrays, (scores, derived, called)):
+            array.append(values)
+        self.samples.writelines('%s\n' % (sample) for sample in sample_id)
+
+    def flush(self):
+        for array in self.arrays:
+            array.flush()
+        self.samples.flush()
+        os.fsync(self.samples.fileno())
+
+    def close(self):
+        for array in self.arrays:
+            array.close()
+        self.samples.close()
+
+
+def has_pyarrow():
+    """checks whether pyarrow is installed, without importing it"""
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+class ParquetScoreWriter(object):
+    """
+    writes a score matrix as a parquet file with one row group per chunk of samples. Each row holds the sample id and
+    fixed-size lists of scores, derived and called counts, in the order of the haplogroup names kept in the metadata
+    """
+
+    def __init__(self, filename, hg_names):
+        import pyarrow.parquet      # imported only when parquet is written, as it is slow to import
+        self.pyarrow = pyarrow
+        n_hgs = len(hg_names)
+        fields = [pyarrow.field('sample', pyarrow.string())]
+        fields.extend(pyarrow.field(name, pyarrow.list_(pyarrow.from_numpy_dtype(np.dtype(dtype)), n_hgs)) for name, dtype in SCORE_ARRAYS)
+        self.schema = pyarrow.schema(fields, metadata={'hg_names': json.dumps(list(hg_names))})
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+
+    def append(self, sample_id, scores, derived, called):
+        pyarrow = self.pyarrow
+        columns = [pyarrow.array(sample_id, type=pyarrow.string())]
+        for (name, dtype), values in zip(SCORE_ARRAYS, (scores, derived, called)):
+            values = np.ascontiguousarray(values, dtype=dtype)
+            columns.append(pyarrow.FixedSizeListArray.from_arrays(pyarrow.array(values.ravel()), values.shape[1]))
+        self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.writer.close()
+
+
+def get_score_matrix_file(prefix, scores_format):
+    """returns where a score matrix in scores_format is written for the output prefix"""
+    return prefix + ('.scores.parquet' if scores_format == 'parquet' else '.scores')
+
+
+def open_score_writer(prefix, scores_format, hg_names, n_rows=None):
+    """
+    opens a score matrix writer for the output prefix. With n_rows, an existing npy score matrix is continued after
+    its first n_rows samples
+    """
+    filename = get_score_matrix_file(prefix, scores_format)
+    if scores_format == 'parquet':
+        return ParquetScoreWriter(filename, hg_names)
+    return NpyScoreWriter(filename, hg_names, n_rows)
+
+
+def load_score_matrix(filename):
+    """
+    loads a score matrix written by SNAPPY, returning the sample ids, the haplogroup names, and samples x haplogroups
+    arrays of scores, derived and called counts. Arrays of an npy score matrix are memory-mapped
+    """
+    if os.path.isdir(filename):
+        with open(os.path.join(filename, SCORE_MATRIX_NAMES), 'r') as infp:
+            hg_names = json.load(infp)['hg_names']
+        with open(os.path.join(filename, SCORE_MATRIX_SAMPLES), 'r') as infp:
+            sample_ids = [line.rstrip('\n') for line in infp]
+        arrays = [np.load(os.path.join(filename, name + '.npy'), mmap_mode='r') for name, dtype in SCORE_ARRAYS]
+        return sample_ids, hg_names, arrays[0], arrays[1], arrays[2]
+    import pyarrow.parquet
+    table = pyarrow.parquet.read_table(filename, memory_map=True)
+    hg_names = json.loads(table.schema.metadata[b'hg_names'])
+    arrays = [np.asarray(table.column(name).combine_chunks().flatten()).reshape(table.num_rows, len(hg_names)) for name, dtype in SCORE_ARRAYS]
+    return table.column('sample').to_pylist(), hg_names, arrays[0], arrays[1], arrays[2]
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+serve.py
+
+Long-running SNAPPY server. The compiled reference is loaded once and kept in memory; concurrent requests are
+gathered into micro-batches and scored together in one vectorized pass. Listens on localhost HTTP or on a Unix socket.
+
+POST /classify takes a json body {"samples": [{"id": "kit1", "calls": {"2655180": "G", ...}}, ...]}, where calls map
+GRCh37 chrY positions to called alleles (missing calls may be left out or given as "0", "." or ""). It returns
+{"results": [{"id": ..., "haplogroup": ..., "leaf_haplogroup": ..., "score": ...}, ...]}, in request order.
+GET /stats returns request counts, batch sizes and latency percentiles; GET /health returns "ok".
+"""
+
+import argparse
+import collections
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import numpy as np
+from snappy.bin.parse_plink_files import GT_MISSING, allele_to_gt
+from snappy.bin.classifier import Classifier
+
+# number of recent requests kept for latency percentiles
+LATENCY_WINDOW = 10000
+
+# missing values accepted in calls
+MISSING_CALLS = ('', '0', '.', 'N', '-')
+
+
+class PendingRequest(object):
+    """the samples of one request, waiting for its batch to be scored"""
+
+    def __init__(self, sample_ids, genotypes):
+        self.sample_ids = sample_ids
+        self.genotypes = genotypes
+        self.received = time.time()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class Batcher(object):
+    """
+    collects requests from handler threads and scores them in batches on one worker thread. A batch is started as
+    soon as a request arrives and takes every request that arrives within batch_wait seconds, up to max_batch samples
+    """
+
+    def __init__(self, classifier, max_batch, batch_wait):
+        self.classifier = classifier
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.queue = collections.deque()
+        self.lock = threading.Condition()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.n_requests = 0
+        self.n_samples = 0
+        self.n_batches = 0
+        self.started = time.time()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, sample_ids, genotypes):
+        """queues samples for scoring and waits for their results"""
+        request = PendingRequest(sample_ids, genotypes)
+        with self.lock:
+            self.queue.append(request)
+            self.lock.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def next_batch(self):
+        with self.lock:
+            while not self.queue:
+                self.lock.wait()
+            deadline = time.time() + self.batch_wait
+            batch = [self.queue.popleft()]
+            n_samples = len(batch[0].sample_ids)
+            while n_samples < self.max_batch:
+                if not self.queue:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.lock.wait(remaining)
+                    continue
+                if n_samples + len(self.queue[0].sample_ids) > self.max_batch:
+                    break
+                batch.append(self.queue.popleft())
+                n_samples += len(batch[-1].sample_ids)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                sample_ids = [sample_id for request in batch for sample_id in request.sample_ids]
+                genotypes = np.concatenate([request.genotypes for request in batch])
+                assignments = self.classifier.classify(genotypes, sample_ids)
+                results = [{'id': sample_id, 'haplogroup': hg, 'leaf_haplogroup': leaf, 'score': round(score, 3)}
+                           for sample_id, hg, leaf, score in zip(sample_ids, assignments.haplogroups, assignments.leaf_haplogroups, assignments.scores.tolist())]
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            start = 0
+            finished = time.time()
+            with self.lock:
+                self.n_batches += 1
+                for request in batch:
+                    self.n_requests += 1
+                    self.n_samples += len(request.sample_ids)
+                    self.latencies.append(finished - request.received)
+            for request in batch:
+                request.results = results[start:start + len(request.sample_ids)]
+                start += len(request.sample_ids)
+                request.done.set()
+
+    def get_stats(self):
+        """returns request counts, the mean batch size and latency percentiles in milliseconds"""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {'requests': self.n_requests, 'samples': self.n_samples, 'batches': self.n_batches,
+                     'mean_batch_samples': round(self.n_samples / float(self.n_batches), 2) if self.n_batches else 0,
+                     'uptime_s': round(time.time() - self.started, 1)}
+        if len(latencies):
+            for percentile in (50, 90, 99):
+                stats['latency_p%s_ms' % (percentile)] = round(float(np.percentile(latencies, percentile)), 3)
+            stats['latency_max_ms'] = round(float(latencies.max()), 3)
+        return stats
+
+
+def calls_to_genotypes(samples, ref_index, pos_to_alleles):
+    """turns the samples of a request into sample ids and a samples x reference-positions genotype matrix"""
+    sample_ids = []
+    genotypes = np.full((len(samples), len(ref_index)), GT_MISSING, dtype=np.int8)
+    for n, sample in enumerate(samples):
+        sample_ids.append(str(sample.get('id', n)))
+        for pos, allele in sample.get('calls', {}).items():
+            pos = str(pos)
+            if pos not in ref_index or allele is None or allele in MISSING_CALLS:
+                continue
+            derived_allele, ancestral_allele = pos_to_alleles[pos]
+            genotypes[n, ref_index[pos]] = allele_to_gt(str(allele).upper(), derived_allele, ancestral_allele)
+    return sample_ids, genotypes
+
+
+class SnappyRequestHandler(BaseHTTPRequestHandler):
+    """handles requests for the server, which holds the batcher and reference lookups"""
+    protocol_version = 'HTTP/1.1'       # keep connections open between requests
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, 'ok')
+        elif self.path == '/stats':
+            self.send_json(200, self.server.batcher.get_stats())
+        else:
+            self.send_json(404, {'error': 'unknown path %s' % (self.path)})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self.send_json(404, {'error': 'unknown path %s' % (self.path)})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+            samples = body['samples'] if isinstance(body, dict) else body
+            sample_ids, genotypes = calls_to_genotypes(samples, self.server.ref_index, self.server.pos_to_alleles)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': 'invalid request: %s' % (e)})
+            return
+        if not sample_ids:
+            self.send_json(200, {'results': []})
+            return
+        try:
+            results = self.server.batcher.submit(sample_ids, genotypes)
+        except Exception as e:
+            self.send_json(500, {'error': 'scoring failed: %s' % (e)})
+            return
+        self.send_json(200, {'results': results})
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix socket'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class SnappyTCPRequestHandler(SnappyRequestHandler):
+    disable_nagle_algorithm = True      # send small responses without waiting on delayed acks
+
+
+class SnappyHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class SnappyUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def get_request(self):
+        request, client_address = socketserver.UnixStreamServer.get_request(self)
+        return request, ('', 0)
+
+
+def serve(args):
+    classifier = Classifier(os.path.join(os.getcwd(), args.ref_files_dir) if args.ref_files_dir else None, args.id2pos, args.pos2allele, args.hg2snp, args.tree_strct,
+                            args.min_hap_score, args.min_deep_score, args.ancestral_hg_depth, args.truncate_haps,
+                            '' if args.no_ref_cache else args.ref_cache_dir)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = SnappyUnixServer(args.socket, SnappyRequestHandler)
+        address = args.socket
+    else:
+        server = SnappyHTTPServer((args.host, args.port), SnappyTCPRequestHandler)
+        address = 'http://%s:%s' % (args.host, server.server_address[1])
+    server.batcher = Batcher(classifier, args.max_batch, args.batch_wait / 1000.0)
+    server.ref_index = dict((str(pos), j) for j, pos in enumerate(classifier.positions.tolist()))
+    server.pos_to_alleles = classifier.refs.pos_to_alleles
+    server.verbose = args.verbose
+    print('SNAPPY server listening on %s' % (address))
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='snappy-serve', description='Serve SNAPPY haplogroup assignments with the reference kept in memory')
+
+    parser.add_argument('--min_hap_score', help='minimum haplogroup score to be considered as assignment', nargs='?', const=1, type=float, default=0.75, required=False)
+    parser.add_argument('--min_deep_score', help='minimum score to switch to deeper node for final assignment', nargs='?', const=1, type=float, default=0.8, required=False)
+    parser.add_argument('--ref_files_dir', help='directory where reference file are stored, by default ref_files if it exists and otherwise the references packaged with SNAPPY', nargs='?', const=1, type=str, required=False)
+    parser.add_argument('--id2pos', help='file listing SNP ids and corresponding positions', nargs='?', const=1, type=str, default='id_to_pos.txt', required=False)
+    parser.add_argument('--pos2allele', help='file listing SNP positions and corresponding alleles', nargs='?', const=1, type=str, default='pos_to_allele.txt', required=False)
+    parser.add_argument('--hg2snp', help='file listing markers and haplogroups', nargs='?', const=1, type=str, default='y_hg_and_snps.sort', required=False)
+    parser.add_argument('--tree_strct', help='file listing haplogroup parent-child relationships for haplogroups that do not confrom to naming convetions', nargs='?', const=1, type=str, default='tree_structure.txt', required=False)
+    parser.add_argument('--ancestral_hg_depth', help='number of ancestral haplogroups to check when considering whether a haplogroup receives a score', nargs='?', const=1, type=int, default=2, required=False)
+    parser.add_argument('--truncate_haps', help='file with list of haplogroups past which SNAPPY will not make assignments', nargs='?', const=1, type=str, required=False)
+    parser.add_argument('--ref_cache_dir', help='directory where compiled reference bundles are cached', type=str, required=False)
+    parser.add_argument('--no_ref_cache', help='parse the reference files on every run instead of caching a compiled bundle', action='store_true', required=False)
+    parser.add_argument('--host', help='address to listen on for http requests', type=str, default='127.0.0.1', required=False)
+    parser.add_argument('--port', help='port to listen on for http requests', type=int, default=8765, required=False)
+    parser.add_argument('--socket', help='listen on this Unix socket instead of http', type=str, required=False)
+    parser.add_argument('--max_batch', help='largest number of samples scored in one batch', type=int, default=1024, required=False)
+    parser.add_argument('--batch_wait', help='milliseconds to wait for more requests to join a batch', type=float, default=2, required=False)
+    parser.add_argument('--verbose', help='log every request', action='store_true', required=False)
+
+    args = parser.parse_args()
+    serve(args)
+    sys.exit()
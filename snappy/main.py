@@ -1,7 +1,9 @@
 import argparse
-from snappy import *
 
-def run_snappy():
+# each command imports its tool only after parsing its arguments, so --help and --version return without loading numpy or scipy
+
+def get_snappy_parser():
+	"""returns the argument parser of the snappy command"""
 	parser = argparse.ArgumentParser(prog='SNAPPY', description="Y-chromosome haplogroup inference")
 
 	parser.add_argument('--version', action='version', version='%(prog)s 0.2.2')
@@ -9,14 +11,36 @@ def run_snappy():
 	parser.add_argument('--min_hap_score', help='minimum haplogroup score to be considered as assignment', nargs='?', const=1, type=float, default=0.75, required=False)
 	parser.add_argument('--min_deep_score', help='minimum score to switch to deeper node for final assignment', nargs='?', const=1, type=float, default=0.8, required=False)
 	parser.add_argument('--out', help='prefix for file output', nargs='?', const=1, type=str, default='chrY_hgs', required=False)
-	parser.add_argument('--ref_files_dir', help='directory where reference file are stored', nargs='?', const=1, type=str, default='ref_files', required=False)
+	parser.add_argument('--ref_files_dir', help='directory where reference file are stored, by default ref_files if it exists and otherwise the references packaged with SNAPPY', nargs='?', const=1, type=str, required=False)
 	parser.add_argument('--id2pos', help='file listing SNP ids and corresponding positions', nargs='?', const=1, type=str, default='id_to_pos.txt', required=False)
 	parser.add_argument('--pos2allele', help='file listing SNP positions and corresponding alleles', nargs='?', const=1, type=str, default='pos_to_allele.txt', required=False)
 	parser.add_argument('--hg2snp', help='file listing markers and haplogroups', nargs='?', const=1, type=str, default='y_hg_and_snps.sort', required=False)
 	parser.add_argument('--tree_strct', help='file listing haplogroup parent-child relationships for haplogroups that do not confrom to naming convetions', nargs='?', const=1, type=str, default='tree_structure.txt', required=False)
 	parser.add_argument('--ancestral_hg_depth', help='number of ancestral haplogroups to check when considering whether a haplogroup receives a score', nargs='?', const=1, type=int, default=2, required=False)
 	parser.add_argument('--truncate_haps', help='file with list of haplogroups past which SNAPPY will not make assignments', nargs='?', const=1, type=str, required=False)
-	args = parser.parse_args()
+	parser.add_argument('--ref_cache_dir', help='directory where compiled reference bundles are cached', type=str, required=False)
+	parser.add_argument('--no_ref_cache', help='parse the reference files on every run instead of caching a compiled bundle', action='store_true', required=False)
+	parser.add_argument('--chunk_size', help='number of samples read and scored at a time', type=int, default=10000, required=False)
+	parser.add_argument('--processes', '--threads', dest='processes', help='number of processes used to score samples', type=int, default=1, required=False)
+	parser.add_argument('--ref_fasta', help='indexed GRCh37 reference genome, used to expand gVCF reference blocks', type=str, required=False)
+	parser.add_argument('--resume', help='continue an interrupted run from its checkpoint, appending to its output', action='store_true', required=False)
+	parser.add_argument('--result_cache', help='SQLite file of cached per-sample results, reused for samples whose genotypes were scored before', type=str, required=False)
+	parser.add_argument('--sweep', help='score every combination of settings such as "min_hap_score=0.6,0.7;min_deep_score=0.8:0.95:0.05;ancestral_hg_depth=1,2" from one pass over the genotypes, writing .sweep.tsv and .sweep_summary.tsv instead of .out and .all', type=str, required=False)
+	parser.add_argument('--sweep_truth', help='tab-separated file of samples and reference haplogroups (eg. an earlier .out file) to measure sweep agreement against', type=str, required=False)
+	parser.add_argument('--metrics', help='json file to write wall time, CPU time and peak memory of each stage, samples per second and counts of unused reference snps to', type=str, required=False)
+	parser.add_argument('--profile', help='file to save cProfile statistics for the run to', type=str, required=False)
+	parser.add_argument('--scores', help='also write the full samples x haplogroups score matrix, with derived and called snp counts, as .npy arrays in {out}.scores or as {out}.scores.parquet', choices=('npy', 'parquet'), type=str, required=False)
+	parser.add_argument('--no_all', help='do not write the .all file', action='store_true', required=False)
+	parser.add_argument('--all_top_k', '--all-top-k', dest='all_top_k', help='list at most this many of the highest scoring haplogroups of each individual in the .all file', type=int, required=False)
+	parser.add_argument('--all_min_score', '--all-min-score', dest='all_min_score', help='list only haplogroups scoring at least this much in the .all file', type=float, default=0, required=False)
+	parser.add_argument('--flip_strand', help='read the alleles of plink snps that match the reference only on the complementary strand from that strand', action='store_true', required=False)
+	parser.add_argument('--drop_ambiguous', help='leave out plink snps at strand-ambiguous (A/T or C/G) reference positions', action='store_true', required=False)
+	parser.add_argument('--allele_report', help='tab-separated file to list each plink snp at a reference position in, with its alleles, the reference alleles and whether they match, are flipped, strand-swapped, ambiguous or incompatible', type=str, required=False)
+	return parser
+
+def run_snappy():
+	args = get_snappy_parser().parse_args()
+	from snappy.bin.SNAPPY import snappy
 	snappy(args)
         
 def clean_isogg_table():
@@ -26,6 +50,7 @@ def clean_isogg_table():
 	parser.add_argument('--out', help='prefix for output', nargs='?', const=1, type=str, default='isogg_snps', required=False)
 	parser.add_argument('--version', action='version', version='%(prog)s alpha')
 	args = parser.parse_args()
+	from snappy.bin.clean_isogg import clean_isogg
 	clean_isogg(args)
 	
 def do_isogg_qc():
@@ -35,20 +60,61 @@ def do_isogg_qc():
 	parser.add_argument('--out', help='prefix for file output', nargs='?', const='snp_qc', type=str, default='snp_qc', required=False)
 	parser.add_argument('--version', action='version', version='%(prog)s alpha')
 	args = parser.parse_args()
+	from snappy.bin.isogg_qc import isogg_qc
 	isogg_qc(args)
     
 def make_ref_files():
 	parser = argparse.ArgumentParser(prog='make_snappy_refs', description="Make a set of reference files for use by SNAPPY")
 	parser.add_argument('--snp_file', help='a tab-separated file containing ISOGG snps', required=True)
-	parser.add_argument('--pos_file', help='list of physical positions of Y-chromosome genotypes, no header', required=True)
+	parser.add_argument('--pos_file', help='lists of physical positions of Y-chromosome genotypes, no header; a set of reference files is made for each', nargs='+', required=True)
 	parser.add_argument('--tree_file', help='list of non-canonical relationships between haplogroups names, distributed with SNAPPY', default='ref_files/tree_structure.txt', required=False)
 	parser.add_argument('--snp_count', help='a target for the number of haplogroup-informative SNPs to include for each haplogroup', type=int, default=5, required=False)
 	parser.add_argument('--max_node_dist', help='the maximim distance from the root to build the tree', type=int, default=99, required=False)
 	parser.add_argument('--build', help='genome build, hg37 or hg38', nargs='?', const='hg37', choices=['hg37', 'hg38'], type=str, default='hg37', required=False)
 	parser.add_argument('--out', help='prefix for file output', nargs='?', const=1, type=str, default='SNAPPY_snp_list', required=False)
+	parser.add_argument('--out_dir', help='directory to write reference files to; with several position files, they are written to a subdirectory named after each', type=str, default='.', required=False)
 	parser.add_argument('--version', action='version', version='%(prog)s alpha')
 	args = parser.parse_args()
+	from snappy.bin.make_snappy_refs import make_snappy_refs
 	make_snappy_refs(args)
         
+def compile_ref_files():
+	parser = argparse.ArgumentParser(prog='compile_refs', description="Compile SNAPPY's reference files into a binary bundle")
+	parser.add_argument('--ref_files_dir', help='directory where reference file are stored', nargs='?', const=1, type=str, default='ref_files', required=False)
+	parser.add_argument('--id2pos', help='file listing SNP ids and corresponding positions', nargs='?', const=1, type=str, default='id_to_pos.txt', required=False)
+	parser.add_argument('--pos2allele', help='file listing SNP positions and corresponding alleles', nargs='?', const=1, type=str, default='pos_to_allele.txt', required=False)
+	parser.add_argument('--hg2snp', help='file listing markers and haplogroups', nargs='?', const=1, type=str, default='y_hg_and_snps.sort', required=False)
+	parser.add_argument('--tree_strct', help='file listing haplogroup parent-child relationships for haplogroups that do not confrom to naming convetions', nargs='?', const=1, type=str, default='tree_structure.txt', required=False)
+	parser.add_argument('--out', help='directory for the compiled bundle, defaults to the reference cache', type=str, required=False)
+	parser.add_argument('--unresolved', help='tab-separated file to list the defining SNPs that cannot be located in, with the reason', type=str, required=False)
+	parser.add_argument('--version', action='version', version='%(prog)s alpha')
+	args = parser.parse_args()
+	from snappy.bin.compile_refs import compile_refs
+	compile_refs(args)
+
+def serve_snappy():
+	parser = argparse.ArgumentParser(prog='snappy-serve', description="Serve SNAPPY haplogroup assignments with the reference kept in memory")
+	parser.add_argument('--min_hap_score', help='minimum haplogroup score to be considered as assignment', nargs='?', const=1, type=float, default=0.75, required=False)
+	parser.add_argument('--min_deep_score', help='minimum score to switch to deeper node for final assignment', nargs='?', const=1, type=float, default=0.8, required=False)
+	parser.add_argument('--ref_files_dir', help='directory where reference file are stored, by default ref_files if it exists and otherwise the references packaged with SNAPPY', nargs='?', const=1, type=str, required=False)
+	parser.add_argument('--id2pos', help='file listing SNP ids and corresponding positions', nargs='?', const=1, type=str, default='id_to_pos.txt', required=False)
+	parser.add_argument('--pos2allele', help='file listing SNP positions and corresponding alleles', nargs='?', const=1, type=str, default='pos_to_allele.txt', required=False)
+	parser.add_argument('--hg2snp', help='file listing markers and haplogroups', nargs='?', const=1, type=str, default='y_hg_and_snps.sort', required=False)
+	parser.add_argument('--tree_strct', help='file listing haplogroup parent-child relationships for haplogroups that do not confrom to naming convetions', nargs='?', const=1, type=str, default='tree_structure.txt', required=False)
+	parser.add_argument('--ancestral_hg_depth', help='number of ancestral haplogroups to check when considering whether a haplogroup receives a score', nargs='?', const=1, type=int, default=2, required=False)
+	parser.add_argument('--truncate_haps', help='file with list of haplogroups past which SNAPPY will not make assignments', nargs='?', const=1, type=str, required=False)
+	parser.add_argument('--ref_cache_dir', help='directory where compiled reference bundles are cached', type=str, required=False)
+	parser.add_argument('--no_ref_cache', help='parse the reference files on every run instead of caching a compiled bundle', action='store_true', required=False)
+	parser.add_argument('--host', help='address to listen on for http requests', type=str, default='127.0.0.1', required=False)
+	parser.add_argument('--port', help='port to listen on for http requests', type=int, default=8765, required=False)
+	parser.add_argument('--socket', help='listen on this Unix socket instead of http', type=str, required=False)
+	parser.add_argument('--max_batch', help='largest number of samples scored in one batch', type=int, default=1024, required=False)
+	parser.add_argument('--batch_wait', help='milliseconds to wait for more requests to join a batch', type=float, default=2, required=False)
+	parser.add_argument('--verbose', help='log every request', action='store_true', required=False)
+	parser.add_argument('--version', action='version', version='%(prog)s 0.2.2')
+	args = parser.parse_args()
+	from snappy.bin.serve import serve
+	serve(args)
+
 if __name__ == "__main__":
         run_snappy()